@@ -0,0 +1,235 @@
+__all__=['LRUCache', 'HandleTable', 'Prefetcher']
+
+import logging
+import threading
+from collections import OrderedDict, deque
+
+class LRUCache(object):
+    '''
+    A mapping that keeps at most maxEntries items, whose total cost stays
+    below maxCost, by evicting the least recently used items first.
+
+    cost:   function returning the (approximate) cost of a value. It is
+            evaluated again whenever the item is accessed, since objects
+            such as search directories grow after they are populated.
+    pinned: function telling whether a value must not be evicted, e.g.
+            because a file handle still holds it open.
+    '''
+    def __init__(self, maxEntries, maxCost=None, cost=None, pinned=None):
+        self.maxEntries = maxEntries
+        self.maxCost = maxCost
+        self._cost = cost or (lambda v: 1)
+        self._pinned = pinned or (lambda v: False)
+
+        self._items = OrderedDict() # key -> [value, cost], LRU first
+        self.totalCost = 0
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._items[key] = item     # now the most recently used
+            cost = self._cost(item[0])
+            if cost!=item[1]:
+                self.totalCost += cost - item[1]
+                item[1] = cost
+                self._shrink()
+            return item[0]
+
+    def put(self, key, value):
+        cost = self._cost(value)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if not old is None:
+                self.totalCost -= old[1]
+            self._items[key] = [value, cost]
+            self.totalCost += cost
+            self._shrink()
+
+    def recost(self, key):
+        '''
+        Evaluates the cost of key's value again, e.g. after it was filled
+        in, and evicts items if the total is now over budget. Unlike get,
+        neither counts as a hit nor marks the item as recently used.
+        '''
+        with self._lock:
+            item = self._items.get(key)
+            if item is None: return
+
+            cost = self._cost(item[0])
+            if cost!=item[1]:
+                self.totalCost += cost - item[1]
+                item[1] = cost
+                self._shrink()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None: return default
+            self.totalCost -= item[1]
+            return item[0]
+
+    def popIf(self, pred):
+        '''
+        Removes all items for which pred(key, value) is true, and returns
+        their keys. Takes linear time.
+        '''
+        with self._lock:
+            keys = [k for k, item in self._items.iteritems()
+                    if pred(k, item[0])]
+            for key in keys:
+                self.totalCost -= self._items.pop(key)[1]
+            return keys
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.totalCost = 0
+
+    def _over(self):
+        if len(self._items) > self.maxEntries: return True
+        return not self.maxCost is None and self.totalCost > self.maxCost
+
+    def _shrink(self):
+        pinned = []
+        while self._items and self._over():
+            key, item = self._items.popitem(last=False)
+            if self._pinned(item[0]):
+                pinned.append((key, item))
+            else:
+                self.totalCost -= item[1]
+
+        # pinned items are in use, so they count as recently used
+        for key, item in pinned:
+            self._items[key] = item
+
+
+class HandleTable(object):
+    '''
+    Maps FUSE file handles to the objects they were opened on.
+
+    Every handle holds a reference on its object until it is released,
+    so refs(obj) tells whether an object is still open somewhere.
+    '''
+    def __init__(self):
+        self._handles = {}
+        self._refs = {}     # id(obj) -> number of open handles
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def open(self, obj):
+        with self._lock:
+            fh = self._next
+            self._next += 1
+            self._handles[fh] = obj
+            self._refs[id(obj)] = self._refs.get(id(obj), 0) + 1
+        return fh
+
+    def get(self, fh, default=None):
+        return self._handles.get(fh, default)
+
+    def release(self, fh):
+        with self._lock:
+            obj = self._handles.pop(fh, None)
+            if obj is None: return None
+
+            n = self._refs[id(obj)] - 1
+            if n:
+                self._refs[id(obj)] = n
+            else:
+                del self._refs[id(obj)]
+        return obj
+
+    def refs(self, obj):
+        return self._refs.get(id(obj), 0)
+
+
+class Prefetcher(object):
+    '''
+    Runs jobs on a few daemon threads in the background.
+
+    Jobs are identified by a key; a job whose key is already waiting is
+    dropped, and so are new jobs once maxQueued of them are waiting, so
+    a burst of requests cannot pile up work nobody will look at.
+    '''
+    def __init__(self, workers, maxQueued=256):
+        self.workers = workers
+        self.maxQueued = maxQueued
+
+        self._queue = deque()   # (key, job), oldest first
+        self._queued = set()
+        self._threads = []
+        self._stopped = False
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def start(self):
+        with self._cond:
+            self._stopped = False
+            for i in xrange(self.workers - len(self._threads)):
+                t = threading.Thread(target=self._run,
+                                     name='prefetch-%d' % len(self._threads))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    def stop(self):
+        '''
+        Drops the waiting jobs and waits for the running ones.
+        '''
+        with self._cond:
+            self._stopped = True
+            self._queue.clear()
+            self._queued.clear()
+            self._cond.notify_all()
+            threads, self._threads = self._threads, []
+
+        for t in threads:
+            t.join()
+
+    def submit(self, key, job):
+        '''
+        Queues job(), unless it is already queued or the queue is full.
+        Returns whether it was queued.
+        '''
+        with self._cond:
+            if self._stopped or not self._threads: return False
+            if key in self._queued or len(self._queue)>=self.maxQueued:
+                return False
+
+            self._queue.append((key, job))
+            self._queued.add(key)
+            self._cond.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopped:
+                    self._cond.wait()
+                if self._stopped: return
+
+                key, job = self._queue.popleft()
+                self._queued.discard(key)
+
+            try:
+                job()
+            except Exception:
+                logging.exception('prefetching %r failed', key)
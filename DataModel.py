@@ -1,6 +1,7 @@
 __all__=['Author', 'Paper', 'TagTree']
 
 import json
+import re
 from collections import defaultdict
 
 def senc(s):
@@ -14,6 +15,22 @@ def senc(s):
     else:
         return str(s)
 
+# LaTeX special characters, as written in BibTeX values
+_BIBTEX_ESCAPES = {u'\\': u'\\textbackslash{}', u'{': u'\\{', u'}': u'\\}',
+                   u'&': u'\\&', u'%': u'\\%', u'$': u'\\$', u'#': u'\\#',
+                   u'_': u'\\_', u'~': u'\\textasciitilde{}',
+                   u'^': u'\\textasciicircum{}'}
+_BIBTEX_SPECIAL = re.compile(u'[%s]' % re.escape(u''.join(_BIBTEX_ESCAPES)))
+_BIBTEX_BRACES = re.compile(u'[\\\\{}]')
+
+def bibEscape(val, verbatim=False):
+    '''
+    Escapes val for a braced BibTeX value. Verbatim values such as URLs
+    are only kept from unbalancing the braces.
+    '''
+    special = _BIBTEX_BRACES if verbatim else _BIBTEX_SPECIAL
+    return special.sub(lambda m: _BIBTEX_ESCAPES[m.group(0)], unicode(val))
+
 class Author(object):
     def __init__(self, **kwargs):
         self.lastname   = kwargs.get('lastname')
@@ -64,8 +81,21 @@ class Author(object):
             else:
                 return u''
 
+    def toBibTeX(self):
+        if self.lastname:
+            if self.firstname:
+                return u'%s, %s' % (self.lastname, self.firstname)
+            return self.lastname
+        return self.name or self.firstname or u''
+
 
 class Paper(object):
+    # Paper attribute -> BibTeX field
+    BIBTEX_FIELDS = [('title', 'title'), ('journal', 'journal'),
+                     ('volume', 'volume'), ('issue', 'number'),
+                     ('pages', 'pages'), ('year', 'year'), ('doi', 'doi'),
+                     ('url', 'url')]
+
     def __init__(self, **kwargs):
         self.doc_id     = kwargs.get('doc_id')
         self.title      = kwargs.get('title')
@@ -150,6 +180,49 @@ class Paper(object):
     def fromJson(sJson):
         return Paper.fromDict(json.loads(sJson))
 
+    def bibKey(self):
+        '''
+        Returns a citation key made of the first author's last name, the
+        year and the first word of the title, e.g. smith2005bayesian.
+        '''
+        parts = []
+        if self.authors:
+            author = self.authors[0]
+            if author.lastname:
+                parts.append(author.lastname)
+            elif author.name:
+                parts.append((author.name.split() or [u''])[-1])
+        if not self.year is None:
+            parts.append(unicode(self.year))
+        if self.title:
+            parts.append((self.title.split() or [u''])[0])
+
+        key = re.sub(r'\W', u'', u''.join(parts).lower(), flags=re.UNICODE)
+        return key or u'paper'
+
+    # BibTeX fields whose values are not LaTeX text
+    BIBTEX_VERBATIM = ('doi', 'url')
+
+    def toBibTeX(self, key):
+        '''
+        Returns the paper as a BibTeX @article entry cited as key.
+        '''
+        lines = [u'@article{%s,' % key]
+        if self.authors:
+            names = [bibEscape(n) for n in (a.toBibTeX() for a in self.authors)
+                     if n]
+            lines.append(u'  author = {%s},' % u' and '.join(names))
+        for attr, field in self.BIBTEX_FIELDS:
+            val = getattr(self, attr)
+            if val is None: continue
+            val = bibEscape(val, field in self.BIBTEX_VERBATIM)
+            lines.append(u'  %s = {%s},' % (field, val))
+        if self.tags:
+            lines.append(u'  keywords = {%s},' %
+                         bibEscape(u', '.join(self.tags)))
+        lines.append(u'}')
+        return u'\n'.join(lines) + u'\n\n'
+
 def _tree():
     return defaultdict(_tree)
 
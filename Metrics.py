@@ -0,0 +1,115 @@
+__all__=['Histogram', 'Metrics']
+
+import math
+import threading
+from collections import defaultdict
+from time import time
+
+class Histogram(object):
+    '''
+    Counts durations in logarithmic buckets, BUCKETS per power of two of
+    microseconds, so percentiles come out within about 20%.
+    '''
+    BUCKETS = 4
+
+    def __init__(self):
+        self.counts = defaultdict(int)  # bucket -> count
+        self.n = 0
+        self.total = 0.0
+
+    def record(self, seconds):
+        us = seconds*1e6
+        bucket = int(math.log(us, 2)*self.BUCKETS) if us>1 else 0
+        self.counts[bucket] += 1
+        self.n += 1
+        self.total += seconds
+
+    def percentile(self, p):
+        '''
+        Returns the upper bound, in seconds, of the bucket holding the
+        p-th percentile.
+        '''
+        rank = p/100.0*self.n
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen>=rank:
+                return 2**(float(bucket+1)/self.BUCKETS)/1e6
+        return 0.0
+
+class Metrics(object):
+    '''
+    Counts what the file system does: latencies of FUSE operations and
+    searches, bytes read per file, and hit rates of the caches handed to
+    watchCache. report() formats it all as text.
+    '''
+    # number of files listed in the bytes read section
+    TOP_FILES = 20
+
+    def __init__(self):
+        self.started = time()
+        self.ops = defaultdict(Histogram)       # operation -> Histogram
+        self.errors = defaultdict(int)          # operation -> count
+        self.queries = defaultdict(Histogram)   # search -> Histogram
+        self.bytesRead = defaultdict(int)       # file name -> bytes
+        self.caches = []                        # (name, LRUCache)
+        self._lock = threading.Lock()
+
+    def op(self, name, seconds, failed=False):
+        with self._lock:
+            self.ops[name].record(seconds)
+            if failed: self.errors[name] += 1
+
+    def query(self, name, seconds):
+        with self._lock:
+            self.queries[name].record(seconds)
+
+    def read(self, name, size):
+        with self._lock:
+            self.bytesRead[name] += size
+
+    def watchCache(self, name, cache):
+        self.caches.append((name, cache))
+
+    @staticmethod
+    def _ms(seconds):
+        return '%.3f' % (seconds*1e3)
+
+    def _histograms(self, title, hists, errors=None):
+        lines = ['%-24s %8s %7s %9s %9s %9s %10s' %
+                 (title, 'calls', 'errors', 'p50 ms', 'p95 ms', 'p99 ms',
+                  'total ms')]
+        for name in sorted(hists):
+            h = hists[name]
+            nerr = errors.get(name, 0) if not errors is None else '-'
+            lines.append('%-24s %8d %7s %9s %9s %9s %10s' %
+                         (name, h.n, nerr, self._ms(h.percentile(50)),
+                          self._ms(h.percentile(95)),
+                          self._ms(h.percentile(99)), self._ms(h.total)))
+        return lines
+
+    def report(self):
+        with self._lock:
+            lines = ['uptime %.1f s' % (time() - self.started), '']
+            lines += self._histograms('operation', self.ops, self.errors)
+            lines.append('')
+            lines += self._histograms('search', self.queries)
+            lines.append('')
+
+            lines.append('%-24s %8s %8s %8s %8s' %
+                         ('cache', 'hits', 'misses', 'hit %', 'entries'))
+            for name, cache in self.caches:
+                total = cache.hits + cache.misses
+                rate = 100.0*cache.hits/total if total else 0.0
+                lines.append('%-24s %8d %8d %8.1f %8d' %
+                             (name, cache.hits, cache.misses, rate,
+                              len(cache)))
+            lines.append('')
+
+            top = sorted(self.bytesRead.iteritems(), key=lambda kv: -kv[1])
+            lines.append('bytes read %d in %d files' %
+                         (sum(self.bytesRead.itervalues()), len(top)))
+            for name, size in top[:self.TOP_FILES]:
+                lines.append('%12d %s' % (size, name))
+
+        return u'\n'.join(lines) + u'\n'
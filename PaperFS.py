@@ -3,19 +3,24 @@
 import logging
 
 from collections import defaultdict
-from errno import ENOENT
+import json
+from errno import ENOENT, EROFS, EPERM, EFAULT, EINVAL, ENODATA, ELOOP
 from stat import S_IFDIR, S_IFLNK, S_IFREG
-import os, os.path
+import os, os.path, mmap
+import ctypes
 import datetime, calendar
-from sys import argv, exit
+import threading, weakref, bisect
+import hashlib
 from time import time
 import re
 
-from fusepy import FUSE, FuseOSError, Operations, LoggingMixIn
+from fusepy import FUSE, FuseOSError, Operations
 
 import u1db
 import DataModel
 from SearchPaper import *
+from Cache import *
+from Metrics import *
 from Utils import *
 
 if not hasattr(__builtins__, 'bytes'):
@@ -33,6 +38,10 @@ def senc(s):
         return str(s)
 
 def cleanFilename(fname):
+    # the names of a directory and its parent cannot be used
+    if fname in (u'.', u'..'):
+        return fname.replace(u'.', u'\uff0e')
+
     for pat, sub in [ ('\/',    u'\u2215'), ('\\\\', '_'),
                       ('\?',    '_'),
                       ('%',     '_'),
@@ -47,20 +56,48 @@ def cleanFilename(fname):
     return fname
 
 
+def epochOf(sdate, default=None):
+    """
+    Converts a 'YYYY-mm-dd HH:MM:SS' date in UTC, the format of
+    Paper.date_import, into epoch seconds. Returns default if sdate is
+    missing or malformed.
+    """
+    try:
+        return calendar.timegm((int(sdate[0:4]),   int(sdate[5:7]),
+                                int(sdate[8:10]),  int(sdate[11:13]),
+                                int(sdate[14:16]), int(sdate[17:19])))
+    except (TypeError, ValueError):
+        return default
+
+def inodeOf(*parts):
+    """
+    Derives an inode number from parts, e.g. a doc_id and the role of a
+    file in the paper's directory, so that an object has the same number
+    wherever and whenever it shows up. Numbers have 62 bits, the top one
+    set, and never clash with the root's 1.
+    """
+    digest = hashlib.sha1(senc(u'\0'.join(parts))).hexdigest()
+    return int(digest[:16], 16)>>3 | 1<<61
+
+
 class Stat(object):
     """
     A Stat object. Describes the attributes of a file or directory.
-    Has all the st_* attributes, as well as dt_atime, dt_mtime and dt_ctime,
-    which are datetime.datetime versions of st_*time. The st_*time versions
-    are in epoch time.
+    Has all the st_* attributes; st_atime, st_mtime and st_ctime are in
+    epoch time.
+
+    Stat objects are immutable, so the attribute dict handed to FUSE is
+    built once and shared by every getattr that returns this Stat. Use
+    replace() to derive a modified copy.
     """
+    __slots__ = ('st_mode', 'st_ino', 'st_nlink', 'st_uid', 'st_gid',
+                 'st_size', 'st_atime', 'st_mtime', 'st_ctime', '_dict')
+
     # Filesize of directories, in bytes.
     DIRSIZE = 4096
 
-    # We can define __init__ however we like, because it's only called by us.
-    # But it has to have certain fields.
-    def __init__(self, path_or_st_mode, st_size=0, st_nlink=1, st_uid=None, st_gid=None,
-            dt_atime=None, dt_mtime=None, dt_ctime=None):
+    def __init__(self, st_mode, st_size=0, st_nlink=1, st_uid=None, st_gid=None,
+            st_atime=None, st_mtime=None, st_ctime=None, st_ino=0):
         """
         Creates a Stat object.
         st_mode: Required. Should be stat.S_IFREG or stat.S_IFDIR ORed with a
@@ -73,98 +110,73 @@ class Stat(object):
             each child).
         st_uid, st_gid: uid/gid of file owner. Defaults to the user who
             mounted the file system.
-        st_atime, st_mtime, st_ctime: atime/mtime/ctime of file.
-            (Access time, modification time, stat change time).
-            These must be datetime.datetime objects, in UTC time.
-            All three values default to the current time.
+        st_atime, st_mtime, st_ctime: atime/mtime/ctime of file, in epoch
+            time. All three values default to the current time.
+        st_ino: inode number, 0 to let FUSE pick one.
         """
-        if isinstance(path_or_st_mode, basestring):
-            fpath = path_or_st_mode
-            st = os.stat(fpath)
-
-            self.st_mode    = st.st_mode
-            self.st_nlink   = st.st_nlink
-            self.st_uid     = st.st_uid
-            self.st_gid     = st.st_gid
-            self.st_size    = st.st_size
-            self.st_atime   = st.st_atime
-            self.st_mtime   = st.st_mtime
-            self.st_ctime   = st.st_ctime
-            return
-        elif isinstance(path_or_st_mode, Stat):
-            ostat = path_or_st_mode
-            self.st_mode    = ostat.st_mode
-            self.st_nlink   = ostat.st_nlink
-            self.st_uid     = ostat.st_uid
-            self.st_gid     = ostat.st_gid
-            self.st_size    = ostat.st_size
-            self.st_atime   = ostat.st_atime
-            self.st_mtime   = ostat.st_mtime
-            self.st_ctime   = ostat.st_ctime
-            return
-        else:
-            st_mode = path_or_st_mode
-
-        self.st_mode = st_mode
-        self.st_ino = 0         # Ignored, but required
-        self.st_dev = 0         # Ignored, but required
-        # Note: Wiki says st_blksize is required (like st_dev, ignored but
-        # required). However, this breaks things and another tutorial I found
-        # did not have this field.
-        self.st_nlink = st_nlink
         if st_uid is None:
             st_uid = os.getuid()
-        self.st_uid = st_uid
         if st_gid is None:
             st_gid = os.getgid()
-        self.st_gid = st_gid
-        self.st_size = st_size
-        now = datetime.datetime.utcnow()
-        self.dt_atime = dt_atime or now
-        self.dt_mtime = dt_mtime or now
-        self.dt_ctime = dt_ctime or now
+        now = int(time())
+
+        _set = object.__setattr__
+        _set(self, 'st_mode',  st_mode)
+        _set(self, 'st_ino',   st_ino)
+        _set(self, 'st_nlink', st_nlink)
+        _set(self, 'st_uid',   st_uid)
+        _set(self, 'st_gid',   st_gid)
+        _set(self, 'st_size',  st_size)
+        _set(self, 'st_atime', now if st_atime is None else st_atime)
+        _set(self, 'st_mtime', now if st_mtime is None else st_mtime)
+        _set(self, 'st_ctime', now if st_ctime is None else st_ctime)
+        _set(self, '_dict', dict((k, getattr(self, k))
+                                 for k in self.__slots__[:-1]))
+
+    @staticmethod
+    def fromPath(fpath):
+        """
+        Creates a Stat object from the attributes of a file on disk.
+        """
+        st = os.stat(fpath)
+        return Stat(st.st_mode, st.st_size, st.st_nlink, st.st_uid, st.st_gid,
+                    st.st_atime, st.st_mtime, st.st_ctime)
+
+    def replace(self, **kwargs):
+        """
+        Returns a copy of this Stat with the given st_* fields replaced.
+        """
+        args = dict((k, getattr(self, k)) for k in self.__slots__[:-1])
+        args.update(kwargs)
+        return Stat(**args)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Stat objects are immutable')
 
     def toDict(self):
-        return dict(st_mode=self.st_mode,   st_nlink=self.st_nlink,
-                    st_uid=self.st_uid,     st_gid=self.st_gid,
-                    st_size=self.st_size,   st_atime=self.st_atime,
-                    st_mtime=self.st_mtime, st_ctime=self.st_ctime)
+        """
+        Returns the attribute dict of this Stat. The dict is shared, so
+        callers must not modify it.
+        """
+        return self._dict
 
     def __repr__(self):
         return ("<Stat st_mode %s, st_nlink %s, st_uid %s, st_gid %s, "
             "st_size %s>" % (self.st_mode, self.st_nlink, self.st_uid,
             self.st_gid, self.st_size))
 
-    def _get_dt_atime(self):
+    @property
+    def dt_atime(self):
         return self.epoch_datetime(self.st_atime)
-    def _set_dt_atime(self, value):
-        self.st_atime = self.datetime_epoch(value)
-    dt_atime = property(_get_dt_atime, _set_dt_atime)
 
-    def _get_dt_mtime(self):
+    @property
+    def dt_mtime(self):
         return self.epoch_datetime(self.st_mtime)
-    def _set_dt_mtime(self, value):
-        self.st_mtime = self.datetime_epoch(value)
-    dt_mtime = property(_get_dt_mtime, _set_dt_mtime)
 
-    def _get_dt_ctime(self):
+    @property
+    def dt_ctime(self):
         return self.epoch_datetime(self.st_ctime)
-    def _set_dt_ctime(self, value):
-        self.st_ctime = self.datetime_epoch(value)
-    dt_ctime = property(_get_dt_ctime, _set_dt_ctime)
 
-    @staticmethod
-    def datetime_epoch(dt):
-        """
-        Converts a datetime.datetime object which is in UTC time
-        (as returned by datetime.datetime.utcnow()) into an int, which represents
-        the number of seconds since the system epoch (also in UTC time).
-        """
-        # datetime.datetime.timetuple converts a datetime into a time.struct_time.
-        # calendar.timegm converts a time.struct_time into epoch time, without
-        # modifying for time zone (so UTC time stays in UTC time, unlike
-        # time.mktime).
-        return calendar.timegm(dt.timetuple())
     @staticmethod
     def epoch_datetime(seconds):
         """
@@ -173,19 +185,6 @@ class Stat(object):
         """
         return datetime.datetime.utcfromtimestamp(seconds)
 
-    def set_times_to_now(self, atime=False, mtime=False, ctime=False):
-        """
-        Sets one or more of atime, mtime and ctime to the current time.
-        atime, mtime, ctime: All booleans. If True, this value is updated.
-        """
-        now = datetime.datetime.utcnow()
-        if atime:
-            self.dt_atime = now
-        if mtime:
-            self.dt_mtime = now
-        if ctime:
-            self.dt_ctime = now
-
     def check_permission(self, uid, gid, flags):
         """
         Checks the permission of a uid:gid with given flags.
@@ -236,6 +235,9 @@ class FSObject(object):
     stat: Stat
     parent: Dir or file system
     """
+    # rough memory footprint of an object, in bytes, for the object cache
+    COST = 512
+
     def __init__(self, name, parent, stat=None):
         self.name = name
         self.parent=parent
@@ -255,6 +257,20 @@ class FSObject(object):
     def __repr__(self):
         return "<%s %s>" % (type(self).__name__, self.name)
 
+    def cost(self):
+        return self.COST
+
+    @property
+    def path(self):
+        if not isinstance(self.parent, FSObject): return '/'
+        return os.path.join(self.parent.path, self.name)
+
+    def xattrs(self):
+        '''
+        Returns the extended attributes, as a dict name -> str.
+        '''
+        return {}
+
 class DirObject(FSObject):
     def __init__(self, name, parent, stat=None):
         if stat is None:
@@ -262,37 +278,186 @@ class DirObject(FSObject):
 
         super(DirObject, self).__init__(name, parent, stat)
 
-        self.fh = self.fsys.newFileHandle(self)
+    def lookup(self, fname):
+        '''
+        Returns the sub-directory object named fname, or None.
+        '''
+        return None
+
+    def open(self, fname, flags):
+        raise FuseOSError(ENOENT)
+
+    def readlink(self, fname):
+        raise FuseOSError(ENOENT)
+
+    def readdirFrom(self, offset):
+        '''
+        Lists the entries after the offset-th one, numbering entries from
+        1 so that a listing can resume from any of them.
+        '''
+        lst = list(self.readdir())[offset:]
+        return [(name, attrs, offset+i+1)
+                for i, (name, attrs, _) in enumerate(lst)]
 
 
 class FileObject(FSObject):
-    pass
+    # whether the kernel may keep cached pages of the file across opens
+    KEEP_CACHE = False
+    # whether reads bypass the page cache, e.g. if the size is not known
+    DIRECT_IO = False
+
+    def readinto(self, fh, buf, offset):
+        '''
+        Reads len(buf) bytes at offset into the ctypes array buf. Files
+        that can fill buf directly override this.
+        '''
+        data = self.read(fh, len(buf), offset)
+        ctypes.memmove(buf, data, len(data))
+        return len(data)
+
+    def writefrom(self, fh, buf, offset):
+        return self.write(fh, buf.raw, offset)
+
+
+class ExportStream(object):
+    '''
+    Serves reads at increasing offsets from a generator of byte chunks,
+    holding on to the current chunk only. Reading backwards starts the
+    generator over.
+    '''
+    def __init__(self, makeChunks):
+        self.makeChunks = makeChunks
+        self._restart()
+
+    def _restart(self):
+        self.chunks = self.makeChunks()
+        self.start = 0  # offset of buf
+        self.buf = ''
+
+    def read(self, size, offset):
+        if offset<self.start:
+            self._restart()
+
+        out = []
+        while size>0:
+            end = self.start + len(self.buf)
+            if offset>=end:
+                chunk = next(self.chunks, None)
+                if chunk is None: break
+                self.start, self.buf = end, chunk
+                continue
+
+            piece = self.buf[offset-self.start:offset-self.start+size]
+            out.append(piece)
+            offset += len(piece)
+            size -= len(piece)
+        return ''.join(out)
+
+class ExportFile(FileObject):
+    '''
+    The papers of a search directory in one file, made while it is
+    read, one paper at a time. Its size is unknown until then, so it is
+    reported as 0 and reads bypass the page cache.
+    '''
+    DIRECT_IO = True
+
+    def __init__(self, name, parent):
+        super(ExportFile, self).__init__(name, parent,
+                                         Stat(S_IFREG|0444, 0, st_nlink=1))
+        self.streams = {} # map FUSE file descriptor to ExportStream
+
+    def getattr(self):
+        return self.stat.toDict()
+
+    def open(self, flags):
+        if flags & (os.O_WRONLY|os.O_RDWR):
+            raise FuseOSError(EROFS)
+
+        fh = self.fsys.newFileHandle(self)
+        self.streams[fh] = ExportStream(self.chunks)
+        return fh
+
+    def chunks(self):
+        '''
+        Yields the contents as byte strings.
+        '''
+        return iter(())
+
+    def read(self, fh, size, offset):
+        return self.streams[fh].read(size, offset)
+
+    def release(self, fh):
+        self.streams.pop(fh, None)
+
+class BibTeXFile(ExportFile):
+    def chunks(self):
+        keys = set()
+        for paper in self.parent.iterPapers():
+            key = key0 = paper.bibKey()
+            cnt = 1
+            while key in keys:
+                cnt += 1
+                key = u'%s_%d' % (key0, cnt)
+            keys.add(key)
+            yield paper.toBibTeX(key).encode('utf-8')
+
+class JsonLinesFile(ExportFile):
+    def chunks(self):
+        for paper in self.parent.iterPapers():
+            dct = paper.toDict()
+            dct['doc_id'] = paper.doc_id
+            yield json.dumps(dct, ensure_ascii=False).encode('utf-8') + '\n'
 
 
 class DirSearch(DirObject):
     '''
     Search result as a directory
     '''
+    # memory held per paper in the result: Paper, its name and stat
+    PAPER_COST = 1024
+
+    # number of papers fetched from the search at a time
+    PAGE_SIZE = 256
+
+    # files listed first in every search directory, holding all its papers
+    EXPORTS = [('papers.bib', BibTeXFile), ('papers.jsonl', JsonLinesFile)]
+
     class Iter(object):
-        def __init__(self, obj):
+        '''
+        Yields (name, attrs, offset) tuples, so that the listing carries
+        the attributes of every entry. Papers are fetched from the search
+        only as the listing reaches them.
+
+        Given an offset, entries are numbered from 1 and the listing
+        resumes after entry number offset. Otherwise all offsets are 0.
+        '''
+        def __init__(self, obj, offset=None):
             self.obj = obj
-            self.curDot  = 0 # cursor for . and ..
-            self.curPapr = 0 # cursor for papers
+            self.numbered = not offset is None
+            self.cur = offset or 0
+            # a listing stays consistent even if the search is refreshed
+            self.papers, self.mapStats = obj._populate(0)
 
         def next(self):
-            if self.curDot==0:
-                self.curDot = 1
-                return '.'
-            elif self.curDot==1:
-                self.curDot = 2
-                return '..'
-
-            if self.curPapr<len(self.obj.papers):
-                r = self.obj.papers[self.curPapr]
-                self.curPapr += 1
-                return r
+            cur = self.cur
+            nexports = len(self.obj.EXPORTS)
+            if cur==0:
+                entry = ('.', self.obj.getattr())
+            elif cur==1:
+                entry = ('..', None)
+            elif cur<2+nexports:
+                name = self.obj.EXPORTS[cur-2][0]
+                entry = (name, self.obj.exports[name].getattr())
+            else:
+                i = cur - 2 - nexports
+                if i>=len(self.papers):
+                    self.papers, self.mapStats = self.obj._populate(i+1)
+                    if i>=len(self.papers): raise StopIteration
+                r = self.papers[i]
+                entry = (r, self.mapStats[r].toDict())
 
-            raise StopIteration
+            self.cur = cur + 1
+            return entry + (self.cur if self.numbered else 0,)
 
         def __iter__(self):
             return self
@@ -301,106 +466,547 @@ class DirSearch(DirObject):
         super(DirSearch, self).__init__(name, parent)
         self.search = search
 
-        self.populated = False
+        self.populated = False  # whether the listing has been started
         self.papers = []
         self.mapPapers = {}
+        self.mapStats = {}
+        self.mapDocs = {}   # doc_id -> name
         self.statPapers = Stat(S_IFDIR|0755, Stat.DIRSIZE, st_nlink=2)
+        self._pages = None  # the rest of the result, None once all listed
+        self._buckets = None    # (papers, buckets) as of that papers list
+        self._lock = threading.Lock()
 
-    def _populate(self):
-        if self.populated: return
+        self.exports = dict((name, cls(name, self))
+                            for name, cls in self.EXPORTS)
 
-        def _incName(fname0):
-            fname = fname0
-            cnt = 1
-            while self.mapPapers.has_key(fname):
-                fname = u'%s(%d)' % (fname0, cnt)
-                cnt += 1
-            return fname
+        with self.fsys.lock:
+            self.fsys.searchDirs.add(self)
 
-        self.search.execute()
+    def cost(self):
+        return self.COST + len(self.papers)*self.PAPER_COST
 
-        for paper in self.search.papers():
-            if not paper.authors is None and len(paper.authors)>0:
-                author = unicode(paper.authors[0])
-            else:
-                author = ''
-            if not paper.year is None:
-                year = '%d' % paper.year
-            else:
-                year = ''
-            if not paper.title is None and len(paper.title)>0:
-                title = _incName(cleanFilename(paper.title))
-            else:
-                title = _incName('Untitled')
+    def namesChanged(self, docIds):
+        '''
+        Runs the search again on next access if it lists any of docIds,
+        papers whose names changed. Returns True in that case.
+        '''
+        if not self.populated or not docIds: return False
+
+        with self._lock:
+            if not any(docId in self.mapDocs for docId in docIds):
+                return False
+            self.populated = False
+            return True
 
-            name = '%s (%s) %s' % (author, year, title)
+    def _populate(self, n=None):
+        '''
+        Lists at least the first n papers of the result, or all of them,
+        and returns the current (papers, mapStats).
+        '''
+        if self.populated and self._pages is None:
+            return self.papers, self.mapStats
+
+        with self._lock:
+            # another thread may have populated while we were waiting
+            if not self.populated:
+                self._start()
+            while not self._pages is None and \
+                  (n is None or len(self.papers)<n):
+                page = next(self._pages, None)
+                self._collectQueryTimes()
+                if page is None:
+                    self._pages = None
+                else:
+                    self._addPapers(page)
+            return self.papers, self.mapStats
 
-            self.mapPapers[name] = paper
-            self.papers.append(name)
+    def _collectQueryTimes(self):
+        # the search times its db queries, handing out pages costs nothing
+        times, self.search.queryTimes = self.search.queryTimes, []
+        name = type(self.search).__name__
+        for seconds in times:
+            self.fsys.metrics.query(name, seconds)
 
+    @staticmethod
+    def _nameParts(paper):
+        if not paper.authors is None and len(paper.authors)>0:
+            author = unicode(paper.authors[0])
+        else:
+            author = ''
+        if not paper.year is None:
+            year = '%d' % paper.year
+        else:
+            year = ''
+        if not paper.title is None and len(paper.title)>0:
+            title = cleanFilename(paper.title)
+        else:
+            title = 'Untitled'
+        return author, year, title
+
+    def _start(self):
+        # fresh lists, so listings in progress keep the ones they have
+        self.papers, self.mapPapers = [], {}
+        self.mapStats, self.mapDocs = {}, {}
+        self._pages = self.search.pages(self.PAGE_SIZE)
         self.populated = True
 
+    def _addPapers(self, page):
+        papers, mapPapers = self.papers, self.mapPapers
+        mapStats, mapDocs = self.mapStats, self.mapDocs
+        statPapers = self.statPapers
+        paperNames = self.fsys.paperNames
+
+        for paper in page:
+            name = paperNames.name(paper.doc_id, PaperNames.baseOf(paper))
+
+            mapPapers[name] = paper
+            mapStats[name] = statPapers.replace(
+                st_mtime=epochOf(paper.date_import, statPapers.st_mtime),
+                st_ino=inodeOf(paper.doc_id, u'dir'))
+            mapDocs[paper.doc_id] = name
+            papers.append(name)
+
+    def _entry(self, fname):
+        '''
+        Returns the Stat of paper fname, or None, listing as much of the
+        result as it takes to find it.
+        '''
+        if self.populated:
+            stat = self.mapStats.get(fname)
+            if not stat is None or self._pages is None:
+                return stat
+        return self._populate()[1].get(fname)
+
+    def paperChanged(self, paper, oldKeys, newKeys):
+        '''
+        Brings the listing up to date after paper was modified, given the
+        indexKeys() of its old and new contents. A paper whose entry keeps
+        its name and date is replaced in place, otherwise the search is run
+        again on next access. Returns True in the latter case.
+        '''
+        if not self.populated: return False
+
+        wasIn = self.search.matches(oldKeys)
+        isIn  = self.search.matches(newKeys)
+        if not (wasIn or isIn): return False
+
+        with self._lock:
+            name = self.mapDocs.get(paper.doc_id)
+            if wasIn and isIn and not name is None:
+                old = self.mapPapers[name]
+                if self._nameParts(old)==self._nameParts(paper) and \
+                   old.date_import==paper.date_import:
+                    self.mapPapers[name] = paper
+                    return False
+
+            self.populated = False
+            return True
+
+    def iterPapers(self):
+        '''
+        Yields the papers of the result in listing order, fetching pages
+        only as they are reached.
+        '''
+        papers, _ = self._populate(0)
+        i = 0
+        while True:
+            if i>=len(papers):
+                papers, _ = self._populate(i+1)
+                if i>=len(papers): return
+
+            paper = self.mapPapers.get(papers[i])
+            if not paper is None:
+                yield paper
+            i += 1
+
+    def _bucketOf(self, paper):
+        if self.fsys.bucketBy=='initial':
+            author = paper.authors[0] if paper.authors else None
+            name = author.lastname or author.name if author else None
+            if name and name[0].isalpha():
+                return name[0].upper()
+            return u'#'
+
+        if paper.year is None:
+            return u'No Year'
+        return u'%d' % paper.year
+
+    def buckets(self):
+        '''
+        Returns the result split by year or first author's initial, as a
+        dict bucket -> names of its papers, if it has more papers than
+        the file system's bucketPapers. Returns None otherwise.
+        '''
+        limit = self.fsys.bucketPapers
+        if not limit: return None
+
+        papers, _ = self._populate(limit+1)
+        if len(papers)<=limit: return None
+        papers, _ = self._populate()
+
+        cached = self._buckets
+        if not cached is None and cached[0] is papers:
+            return cached[1]
+
+        mapPapers = self.mapPapers
+        buckets = defaultdict(list)
+        for name in papers:
+            paper = mapPapers.get(name)
+            if not paper is None:
+                buckets[self._bucketOf(paper)].append(name)
+        self._buckets = (papers, buckets)
+        return buckets
+
     def getattr(self, fname=None):
         if fname is None: return self.stat.toDict()
 
-        if not self.populated: self._populate()
+        if fname in self.exports:
+            return self.exports[fname].getattr()
+
+        buckets = self.buckets()
+        if not buckets is None:
+            if fname in buckets:
+                return self.statPapers.toDict()
+            raise FuseOSError(ENOENT)
 
-        if self.mapPapers.has_key(fname):
-            paper = self.mapPapers[fname]
-            stat = Stat(self.statPapers)
-            stat.dt_mtime = datetime.datetime.strptime(paper.date_import, '%Y-%m-%d %H:%M:%S')
+        stat = self._entry(fname)
+        if not stat is None:
             return stat.toDict()
         raise FuseOSError(ENOENT)
 
-    def opendir(self, fname):
-        if not self.populated: self._populate()
+    def open(self, fname, flags):
+        if fname in self.exports:
+            return self.exports[fname].open(flags)
+        raise FuseOSError(ENOENT)
 
-        if self.mapPapers.has_key(fname):
-            dirPaper = DirPaper(fname, stat=self.statPapers, parent=self)
-            return dirPaper.fh
+    def lookup(self, fname):
+        buckets = self.buckets()
+        if not buckets is None:
+            if fname in buckets:
+                return DirBucket(fname, self)
+            return None
+
+        stat = self._entry(fname)
+        if not stat is None:
+            return DirPaper(fname, stat=stat, parent=self)
 
     def readdir(self):
-        if not self.populated: self._populate()
+        buckets = self.buckets()
+        if buckets is None:
+            return DirSearch.Iter(self)
+
+        attrs = self.statPapers.toDict()
+        lst = [('.', self.getattr(), 0), ('..', None, 0)]
+        lst.extend([(name, self.exports[name].getattr(), 0)
+                    for name, _ in self.EXPORTS])
+        lst.extend([(bucket, attrs, 0) for bucket in sorted(buckets)])
+        return lst
+
+    def readdirFrom(self, offset):
+        if self.buckets() is None:
+            return DirSearch.Iter(self, offset)
+        return super(DirSearch, self).readdirFrom(offset)
+
+    def prefetch(self):
+        '''
+        Lists the whole result ahead of use, e.g. from a worker thread.
+        Threads needing the listing meanwhile wait for it to finish.
+        '''
+        self._populate()
+
+class BucketSearch(Search):
+    '''
+    The papers of one bucket of a search directory, see DirSearch.buckets
+    '''
+    def __init__(self, dirSearch, bucket):
+        super(BucketSearch, self).__init__(dirSearch.fsys.db)
+        self.dirSearch = dirSearch
+        self.bucket = bucket
+
+    def execute(self):
+        buckets = self.dirSearch.buckets() or {}
+        mapPapers = self.dirSearch.mapPapers
+        self._papers = [mapPapers[name] for name in buckets.get(self.bucket, ())
+                        if name in mapPapers]
+
+    def pages(self, size):
+        # no query of its own, the parent's searches are counted
+        self.execute()
+        for i in xrange(0, len(self._papers), size):
+            yield self._papers[i:i+size]
+
+    def matches(self, keys):
+        return self.dirSearch.search.matches(keys)
+
+class DirBucket(DirSearch):
+    '''
+    A bucket of a search directory too big to list as is. Buckets are
+    not split any further.
+    '''
+    def __init__(self, name, parent):
+        super(DirBucket, self).__init__(name, parent,
+                                        BucketSearch(parent, name))
+
+    def buckets(self):
+        return None
 
-        return DirSearch.Iter(self)
 
 class DirIndex(DirObject):
-    def __init__(self, name, parent, index, stat=None):
+    '''
+    The keys of an index as search directories. Past SHARD_KEYS keys it
+    lists shards instead: sub-directories of the keys that start with
+    the same prefix, one character longer than the prefix of this
+    directory. A key equal to that prefix, or alone in its shard, is
+    listed as it is.
+    '''
+    KEY_COST = 128
+    # memory of the attrs of a listed name
+    STAT_COST = 1024
+
+    # most keys listed in one directory
+    SHARD_KEYS = 2000
+    # shards whose prefix is no valid file name, and the names they get.
+    # cleanFilename leaves no % in keys, so no key is listed as them.
+    RESERVED = {u'.': u'%2E', u'..': u'%2E%2E'}
+
+    def __init__(self, name, parent, index, stat=None, prefix=u'',
+                 keys=None, mapKeys=None):
         super(DirIndex, self).__init__(name, parent, stat)
         self.index = index
+        self.prefix = prefix
 
-        self.keys    = []
-        self.mapKeys = {}
-        for key in index.keys():
+        with self.fsys.lock:
+            self.fsys.indexDirs.add(self)
+
+        self.statSearch = Stat(S_IFDIR|0755, Stat.DIRSIZE, st_nlink=2)
+        # listed name -> its attrs, with the inode its path gives it, so
+        # listings hand out the same dicts every time
+        self.keyStats = {}
+
+        # sorted names of the keys starting with prefix, and name -> key.
+        # A shard gets them from its parent, the top directory loads them
+        # when first used.
+        self.keys, self.mapKeys = keys, mapKeys
+        self.shards = None  # shard prefix -> number of keys in it
+        if not keys is None:
+            self.shards = self._countShards(keys)
+            self._loadStats()
+        self._lock = threading.Lock()
+
+    def cost(self):
+        return self.COST + len(self.keys or ())*self.KEY_COST + \
+               len(self.keyStats)*self.STAT_COST
+
+    def _load(self):
+        if not self.keys is None: return
+        with self._lock:
+            if not self.keys is None: return
+
+            mapKeys = dict((cleanFilename(key), key)
+                           for key in self.index.keys())
+            keys = sorted(mapKeys)
+            self.shards = self._countShards(keys)
+            self.mapKeys = mapKeys
+            self.keys = keys
+            self._loadStats()
+
+    def _entryStat(self, name):
+        attrs = self.keyStats.get(name)
+        if attrs is None:
+            fpath = os.path.join(self.path, name)
+            attrs = dict(self.statSearch.toDict(),
+                         st_ino=inodeOf(u'path', fpath))
+        return attrs
+
+    def _loadStats(self):
+        # keeps the attrs of the names still listed, makes those of new ones
+        if self.sharded:
+            names = [name for name, _ in self._listing()]
+        else:
+            names = self.keys
+        self.keyStats = dict((name, self._entryStat(name)) for name in names)
+
+    def _shardOf(self, name):
+        # the shard listing name, None if listed as it is
+        n = len(self.prefix) + 1
+        if len(name)<n: return None
+        return name[:n]
+
+    def _countShards(self, names):
+        shards = defaultdict(int)
+        for name in names:
+            shard = self._shardOf(name)
+            if not shard is None:
+                shards[shard] += 1
+        return shards
+
+    @property
+    def sharded(self):
+        self._load()
+        return len(self.keys)>self.SHARD_KEYS
+
+    def listedKeys(self):
+        '''
+        Returns the names listed, in order, with None in place of shards.
+        '''
+        if not self.sharded: return self.keys
+        return [None if isShard else name for name, isShard in self._listing()]
+
+    def _listing(self):
+        # the names listed when sharded, each with whether it is a shard
+        lst = []
+        if self.prefix in self.mapKeys:
+            lst.append((self.prefix, False))
+        for shard in sorted(self.shards):
+            if self.shards[shard]>1:
+                lst.append((self._shardName(shard), True))
+            else:
+                key = self.keys[bisect.bisect_left(self.keys, shard)]
+                lst.append((key, False))
+        return lst
+
+    def _isShard(self, fname):
+        return self.shards.get(self._shardPrefix(fname), 0)>1
+
+    def _shardName(self, shard):
+        return self.RESERVED.get(shard, shard)
+
+    def _shardPrefix(self, fname):
+        for shard, name in self.RESERVED.iteritems():
+            if fname==name and len(shard)==len(self.prefix)+1:
+                return shard
+        return fname
+
+    def hasEntry(self, fname):
+        if not self.sharded:
+            return fname in self.mapKeys
+        elif self._isShard(fname):
+            return True
+        elif not fname in self.mapKeys:
+            return False
+        return fname==self.prefix or self.shards[self._shardOf(fname)]==1
+
+    def keysChanged(self, oldKeys, newKeys):
+        '''
+        Adds the keys a modified paper gained, and removes those it lost
+        if no other paper has them, given the indexKeys() of its old and
+        new contents.
+        '''
+        if self.keys is None: return
+
+        idx, bucket = self.index.INDEX, self.index.bucket
+        old = set(bucket(k) for k in oldKeys.get(idx, ()))
+        new = set(bucket(k) for k in newKeys.get(idx, ()))
+
+        keys, mapKeys = list(self.keys), dict(self.mapKeys)
+        shards = defaultdict(int, self.shards)
+        for key in new - old:
+            name = cleanFilename(key)
+            if name.startswith(self.prefix) and not name in mapKeys:
+                bisect.insort(keys, name)
+                mapKeys[name] = key
+                shard = self._shardOf(name)
+                if not shard is None:
+                    shards[shard] += 1
+        for key in old - new:
             name = cleanFilename(key)
-            self.keys.append(name)
-            self.mapKeys[name] = key
+            if name in mapKeys and not self.index.hasKey(key):
+                del keys[bisect.bisect_left(keys, name)]
+                del mapKeys[name]
+                shard = self._shardOf(name)
+                if not shard is None:
+                    shards[shard] -= 1
+                    if not shards[shard]: del shards[shard]
+
+        self.keys, self.mapKeys, self.shards = keys, mapKeys, shards
+        self._loadStats()
+
+    def getattr(self, fname=None):
+        if fname is None: return self.stat.toDict()
+
+        if self.hasEntry(fname):
+            return self._entryStat(fname)
+        raise FuseOSError(ENOENT)
+
+
+    def lookup(self, fname):
+        if not self.hasEntry(fname): return None
+
+        keys, mapKeys = self.keys, self.mapKeys
+        if self.sharded and self._isShard(fname):
+            # the keys of a shard are a range of the sorted names
+            prefix = self._shardPrefix(fname)
+            lo = bisect.bisect_left(keys, prefix)
+            hi = bisect.bisect_left(keys, prefix + u'\uffff')
+            return DirIndex(fname, self, self.index, prefix=prefix,
+                            keys=keys[lo:hi],
+                            mapKeys=dict((name, mapKeys[name])
+                                         for name in keys[lo:hi]))
+
+        search = self.index.get(mapKeys[fname])
+        return DirSearch(fname, self, search)
+
+    def readdir(self):
+        lst = [('.', self.getattr(), 0), ('..', None, 0)]
+        if not self.sharded:
+            lst.extend([(key, self._entryStat(key), 0) for key in self.keys])
+            return lst
+
+        lst.extend([(name, self._entryStat(name), 0)
+                    for name, _ in self._listing()])
+        return lst
+
+
+class DirTags(DirObject):
+    '''
+    A node of the tag hierarchy. Sub-directories are made when first
+    looked up, so branches nobody opens cost nothing.
+    '''
+    ALL_NAME = u'All'
+
+    def __init__(self, name, parent, tree, parts=(), stat=None):
+        super(DirTags, self).__init__(name, parent, stat)
+        self.tree = tree
+        # the tag of this node, innermost first, e.g. ('bayes', 'stats')
+        self.parts = tuple(parts)
 
         self.statSearch = Stat(S_IFDIR|0755, Stat.DIRSIZE, st_nlink=2)
 
+    def _search(self, parts):
+        return ByTag(self.fsys.db, u':'.join(parts).lower())
+
     def getattr(self, fname=None):
         if fname is None: return self.stat.toDict()
 
-        if fname in self.keys:
+        if fname==self.ALL_NAME or fname in self.tree:
             return self.statSearch.toDict()
         raise FuseOSError(ENOENT)
 
+    def lookup(self, fname):
+        if fname==self.ALL_NAME:
+            return DirSearch(fname, self, self._search(self.parts))
+        elif not fname in self.tree:
+            return None
 
-    def opendir(self, fname):
-        if self.mapKeys.has_key(fname):
-            key = self.mapKeys[fname]
-            search = self.index.get(key)
-            dirSearch = DirSearch('fname', self, search)
-            return dirSearch.fh
+        parts = (fname,) + self.parts
+        subtree = DataModel.TagTree(self.tree[fname])
+        if subtree.childCount()==0:
+            return DirSearch(fname, self, self._search(parts))
+        return DirTags(fname, self, subtree, parts)
 
     def readdir(self):
-        return self.keys
+        attrs = self.statSearch.toDict()
+        lst = [('.', self.getattr(), 0), ('..', None, 0),
+               (self.ALL_NAME, attrs, 0)]
+        lst.extend([(tag, attrs, 0) for tag, _ in self.tree.children()])
+        return lst
 
 
 class DirPaper(DirObject):
     '''
     Paper as a directory
     '''
+    JSON_NAME = u'json.txt'
 
     def __init__(self, name, parent, stat=None):
         if stat:
@@ -411,41 +1017,139 @@ class DirPaper(DirObject):
 
         paper = self.parent.mapPapers[self.name]
         self.paper = paper
+        # the paper's files are the same in every directory listing it,
+        # about 1 + as many as it has index keys
+        self.nlink = 1 + sum(len(keys) for keys in
+                             indexKeys(paper.toDict()).itervalues())
 
         self.pdf = None
         if not paper.path is None:
-            self.pdf = PDFFile(u'%s.pdf'%cleanFilename(paper.title),
-                               os.path.join(self.fsys.repoDir, 'repo', paper.path[0:2], paper.path),
-                               self)
-
-
-        self.fjson = JsonFile(u'json.txt', self)
+            cls = PDFLink if self.fsys.linkPDFs else PDFFile
+            self.pdf = cls(u'%s.pdf'%cleanFilename(paper.title),
+                           os.path.join(self.fsys.repoDir, 'repo', paper.path[0:2], paper.path),
+                           self)
+
+        self._fjson = None
+        # files editors create while saving, until renamed over json.txt
+        self.scratch = {}
+        self._xattrs = (None, None)   # (paper, its xattrs)
+
+    @property
+    def fjson(self):
+        # serializing the paper is only worth it once json.txt is used
+        if self._fjson is None:
+            with self.fsys.lock:
+                if self._fjson is None:
+                    self._fjson = JsonFile(self.JSON_NAME, self)
+        return self._fjson
+
+    def cost(self):
+        cost = self.COST + sum(f.cost() for f in self.scratch.itervalues())
+        if self._fjson is None: return cost
+        return cost + self._fjson.cost()
+
+    # Paper fields served as user.paper.<field> extended attributes
+    XATTR_FIELDS = '''doc_id title year authors journal volume issue pages
+                      doi url tags date_import'''.split()
+
+    def xattrs(self):
+        paper, xattrs = self._xattrs
+        if paper is self.paper: return xattrs
+
+        paper, xattrs = self.paper, {}
+        for field in self.XATTR_FIELDS:
+            val = getattr(paper, field)
+            if val is None: continue
+
+            if field=='authors':
+                val = u'; '.join(n for n in map(unicode, val) if n)
+            elif field=='tags':
+                val = u', '.join(val)
+            elif not isinstance(val, basestring):
+                val = unicode(val)
+            xattrs['user.paper.' + field] = senc(val)
+        self._xattrs = (paper, xattrs)
+        return xattrs
+
+    def file(self, fname):
+        '''
+        Returns the FileObject named fname.
+        '''
+        if self.pdf and fname==self.pdf.name:
+            return self.pdf
+        elif fname==self.JSON_NAME:
+            return self.fjson
+        elif fname in self.scratch:
+            return self.scratch[fname]
+        raise FuseOSError(ENOENT)
 
     def getattr(self, fname=None):
         if fname is None: return self.stat.toDict()
+        return self.file(fname).getattr()
 
-        if self.pdf and fname==self.pdf.name:
-            return self.pdf.getattr()
-        elif fname==self.fjson.name:
-            return self.fjson.getattr()
+    def open(self, fname, flags):
+        return self.file(fname).open(flags)
 
-        raise FuseOSError(ENOENT)
+    def readlink(self, fname):
+        fobj = self.file(fname)
+        if not isinstance(fobj, PDFLink):
+            raise FuseOSError(EINVAL)
+        return fobj.target
 
-    def opendir(self, fname):
-        return None     # no more sub dir
+    def truncate(self, fname, length):
+        fobj = self.file(fname)
+        if fobj is self.pdf:
+            raise FuseOSError(EROFS)
+        fobj.truncate(None, length)
 
-    def open(self, fname, flags):
+    def create(self, fname, flags):
         if self.pdf and fname==self.pdf.name:
-            return self.pdf.open(flags)
-        elif fname==self.fjson.name:
-            return self.fjson.open(flags)
-        raise FuseOSError(ENOENT)
+            raise FuseOSError(EROFS)
+        elif fname==self.JSON_NAME:
+            self.fjson.truncate(None, 0)
+        elif not fname in self.scratch:
+            self.scratch[fname] = BufferFile(fname, self)
+        return self.open(fname, flags)
+
+    def unlink(self, fname):
+        if not fname in self.scratch:
+            self.file(fname)
+            raise FuseOSError(EPERM)
+        del self.scratch[fname]
+
+    def rename(self, ofname, nfname):
+        '''
+        Renaming a scratch file over json.txt stores its contents, which
+        is how many editors save. Renaming json.txt away leaves a copy
+        of it, a paper always has its metadata.
+        '''
+        if ofname==nfname:
+            return self.file(ofname)
+        elif ofname==self.JSON_NAME:
+            data = self.fjson.data
+        elif ofname in self.scratch:
+            data = self.scratch.pop(ofname).data
+        else:
+            self.file(ofname)
+            raise FuseOSError(EPERM)
+
+        if nfname==self.JSON_NAME:
+            fjson = self.fjson
+            fjson.truncate(None, 0)
+            fjson.write(None, data, 0)
+            fjson.commit()
+        elif self.pdf and nfname==self.pdf.name:
+            raise FuseOSError(EPERM)
+        else:
+            self.scratch[nfname] = BufferFile(nfname, self, data)
 
     def readdir(self):
-        lst = ['.', '..']
+        lst = [('.', self.getattr(), 0), ('..', None, 0)]
         if self.pdf:
-            lst.append(self.pdf.name)
-        lst.append(self.fjson.name)
+            lst.append((self.pdf.name, self.pdf.getattr(), 0))
+        lst.append((self.JSON_NAME, self.fjson.getattr(), 0))
+        for fname, fobj in sorted(self.scratch.iteritems()):
+            lst.append((fname, fobj.getattr(), 0))
         return lst
 
 
@@ -457,7 +1161,7 @@ class DirSimple(DirObject):
         self.mapSubdirs = {}
 
     def appendChild(self, dobj):
-        if not isinstance(dobj, DirObject):
+        if not isinstance(dobj, FSObject):
             raise TypeError
 
         self.subdirs.append(dobj.name)
@@ -476,29 +1180,64 @@ class DirSimple(DirObject):
 
         raise FuseOSError(ENOENT)
 
-    def opendir(self, fname):
+    def lookup(self, fname):
         d = self.mapSubdirs.get(fname)
-        if isinstance(d, FSObject):
-            return d.fh
+        if isinstance(d, DirObject):
+            return d
+
+    def open(self, fname, flags):
+        f = self.mapSubdirs.get(fname)
+        if isinstance(f, FileObject):
+            return f.open(flags)
+        raise FuseOSError(ENOENT)
 
     def readdir(self):
-        lst = ['.', '..']
-        lst.extend(self.subdirs)
+        lst = [('.', self.getattr(), 0), ('..', None, 0)]
+        for name in self.subdirs:
+            lst.append((name, self.mapSubdirs[name].getattr(), 0))
 
         return lst
 
+    def _query(self, fname):
+        # the Query fname stands for, or None for a plain name
+        if not Query.isQuery(fname): return None
+        try:
+            return Query(self.fsys.db, fname)
+        except QueryError:
+            return None
+
     def mkdir(self, fname):
-        dobj = DirSimple(fname, parent=self)
+        '''
+        Makes a folder, or a search if fname is a Query.
+        '''
+        query = self._query(fname)
+        if query is None:
+            dobj = DirSimple(fname, parent=self)
+        else:
+            dobj = DirSearch(fname, parent=self, search=query)
         self.appendChild(dobj)
 
     def rename(self, ofname, nfname):
+        '''
+        Turns the folder ofname into a search named nfname. A Query is
+        run as such, any other name gets a sub-directory per index
+        listing the papers with keys starting with it.
+        '''
         dobj = self.mapSubdirs[ofname]
-        if not isinstance(dobj, DirSimple):
+        if not isinstance(dobj, DirSimple) and \
+           not (isinstance(dobj, DirSearch) and isinstance(dobj.search, Query)):
             raise TypeError
 
+        query = self._query(nfname)
+        if not query is None:
+            dobj = DirSearch(nfname, parent=self, search=query)
+        elif not isinstance(dobj, DirSimple):
+            dobj = DirSimple(nfname, parent=self)
+
         self.subdirs[ self.subdirs.index(ofname) ] = nfname
         del self.mapSubdirs[ofname]
         self.mapSubdirs[nfname] = dobj
+        if isinstance(dobj, DirSearch): return
 
         dobj.clear()
         dobj.name = nfname
@@ -517,97 +1256,658 @@ class DirSimple(DirObject):
         dTitle = DirSearch(u'By Title Words', parent=dobj, search=s)
         dobj.appendChild(dTitle)
 
+class MappedFile(object):
+    '''
+    A read-only mmap of a file in the repo, shared by all handles open on
+    it. Repo files are content-addressed and never change, so readers can
+    slice the mapping concurrently without seeking or locking.
+    '''
+    def __init__(self, osPath):
+        self.osPath = osPath
+        self.refs = 0
+
+        fd = os.open(osPath, os.O_RDONLY)
+        try:
+            self.size = os.fstat(fd).st_size
+            # empty files cannot be mapped
+            self.mm = None
+            if self.size>0:
+                # a private mapping, so that ctypes can take its address;
+                # it is never written, so no page is ever copied
+                self.mm = mmap.mmap(fd, 0, access=mmap.ACCESS_COPY)
+                self._base = ctypes.c_char.from_buffer(self.mm)
+                self.addr = ctypes.addressof(self._base)
+        finally:
+            os.close(fd)
+
+    def read(self, size, offset):
+        if self.mm is None: return ''
+        return self.mm[offset:offset+size]
+
+    def readinto(self, buf, offset):
+        '''
+        Copies from the mapping straight into buf, a ctypes array.
+        '''
+        size = max(0, min(len(buf), self.size-offset))
+        if size>0:
+            ctypes.memmove(buf, self.addr+offset, size)
+        return size
+
+    def close(self):
+        if not self.mm is None:
+            del self._base
+            self.mm.close()
+            self.mm = None
+
+
+class PaperNames(object):
+    '''
+    Hands out the names of paper directories, so that a paper has the
+    same name in every listing, across refreshes and across mounts. A
+    paper is named "Author (year) Title". Of the papers sharing that
+    name, the one with the smallest doc_id keeps it, the others get hex
+    digits of the SHA-1 of their doc_id added, as few as keep them
+    apart, e.g. "Author (year) Title [3fa2c1]".
+
+    Which papers share a name is learnt from a scan of the db in the
+    background at mount, and names are handed out once it is done, so
+    they do not depend on which listing came first. Later changes come
+    in through update and docsChanged.
+    '''
+    # hex digits tried first
+    DIGITS = 6
+
+    def __init__(self):
+        self._bases = {}    # doc_id -> plain name
+        self._groups = {}   # plain name -> set of doc_ids
+        self._names = {}    # doc_id -> name, of papers sharing a plain name
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def __len__(self):
+        return len(self._bases)
+
+    @staticmethod
+    def baseOf(paper):
+        return u'%s (%s) %s' % DirSearch._nameParts(paper)
+
+    @staticmethod
+    def _docBase(doc):
+        if doc is None or not isinstance(doc.content, dict): return None
+        return PaperNames.baseOf(DataModel.Paper.fromDict(doc.content))
+
+    def start(self, db):
+        t = threading.Thread(target=self._scan, args=(db,),
+                             name='paper-names')
+        t.daemon = True
+        t.start()
+
+    def _scan(self, db):
+        try:
+            _, docs = db.get_all_docs()
+            with self._lock:
+                for doc in docs:
+                    self._set(doc.doc_id, self._docBase(doc))
+        except Exception:
+            logging.exception('naming the papers failed')
+        finally:
+            self._ready.set()
+
+    def _set(self, docId, base):
+        old = self._bases.get(docId)
+        if old==base: return
+        if not old is None:
+            group = self._groups[old]
+            group.discard(docId)
+            if not group: del self._groups[old]
+            del self._bases[docId]
+        if not base is None:
+            self._bases[docId] = base
+            self._groups.setdefault(base, set()).add(docId)
+
+    def _move(self, docId, base):
+        # the names of both groups are worked out again when next asked for
+        for b in (self._bases.get(docId), base):
+            for other in self._groups.get(b, ()):
+                self._names.pop(other, None)
+        self._names.pop(docId, None)
+        self._set(docId, base)
+
+    def _groupNames(self, base):
+        ids = self._groups[base]
+        owner = min(ids)
+        names = {owner: base}
+        digests = sorted((hashlib.sha1(senc(docId)).hexdigest(), docId)
+                         for docId in ids if docId!=owner)
+        for i, (digest, docId) in enumerate(digests):
+            # digits it shares with its neighbours in sorted order
+            shared = 0
+            for j in (i-1, i+1):
+                if 0<=j<len(digests):
+                    common = os.path.commonprefix([digest, digests[j][0]])
+                    shared = max(shared, len(common))
+            n = self.DIGITS
+            while n<=shared: n += 2
+            names[docId] = u'%s [%s]' % (base, digest[:n])
+        return names
+
+    def _name(self, docId, base):
+        if len(self._groups[base])==1: return base
+        name = self._names.get(docId)
+        if name is None:
+            self._names.update(self._groupNames(base))
+            name = self._names[docId]
+        return name
+
+    def name(self, docId, base):
+        '''
+        Returns the name of paper docId, whose plain name is base.
+        '''
+        self._ready.wait()
+        with self._lock:
+            if self._bases.get(docId)!=base:
+                # not in the db as scanned, e.g. created since
+                self._move(docId, base)
+            return self._name(docId, base)
+
+    def update(self, docId, base):
+        '''
+        Gives paper docId the plain name base, None if it was deleted.
+        Returns the ids of the other papers whose names changed.
+        '''
+        self._ready.wait()
+        with self._lock:
+            bases = [b for b in (self._bases.get(docId), base)
+                     if not b is None]
+            before = self._namesOf(bases)
+            self._move(docId, base)
+            after = self._namesOf(bases)
+        return set(other for other, name in before.iteritems()
+                   if other!=docId and after.get(other)!=name)
+
+    def _namesOf(self, bases):
+        names = {}
+        for base in bases:
+            for docId in self._groups.get(base, ()):
+                names[docId] = self._name(docId, base)
+        return names
+
+    def docsChanged(self, db, docIds):
+        '''
+        Brings the names of documents changed by other processes up to
+        date, forgetting those deleted.
+        '''
+        docs = dict((doc.doc_id, doc)
+                    for doc in db.get_docs(docIds, check_for_conflicts=False,
+                                           include_deleted=True))
+        self._ready.wait()
+        with self._lock:
+            for docId in docIds:
+                self._move(docId, self._docBase(docs.get(docId)))
+
+
+class LibraryStats(object):
+    '''
+    Size of the repo store and number of documents, for statfs. They are
+    counted once in the background at mount, then kept up to date from
+    the changes to the db, so reading them costs nothing. Only live
+    documents count, and only the repo files they refer to.
+    '''
+    def __init__(self, repoDir):
+        self.repoDir = repoDir
+        self.docs = {}      # doc id -> name of its repo file, or None
+        self.files = {}     # name of a repo file -> [size, number of docs]
+        self.size = 0
+        self.ready = False
+        self._changed = set()   # doc ids changed during the scan
+        self._lock = threading.Lock()
+
+    def osPath(self, path):
+        return os.path.join(self.repoDir, 'repo', path[0:2], path)
+
+    def start(self, db):
+        t = threading.Thread(target=self._scan, args=(db,),
+                             name='library-stats')
+        t.daemon = True
+        t.start()
+
+    def _scan(self, db):
+        try:
+            # get_all_docs leaves deleted documents out
+            _, docs = db.get_all_docs()
+            for doc in docs:
+                if doc.doc_id in self._changed: continue
+                self._setDoc(doc.doc_id, doc)
+        except Exception:
+            logging.exception('counting the library failed')
+        finally:
+            with self._lock:
+                self.ready = True
+                self._changed.clear()
+
+    def _setDoc(self, docId, doc):
+        # counts docId with the repo file of doc, None if it was deleted
+        if doc is None or doc.content is None:
+            with self._lock:
+                self._dropDoc(docId)
+            return
+
+        name, size = None, None
+        path = doc.content.get('path') if isinstance(doc.content, dict) \
+               else None
+        if isinstance(path, basestring):
+            # repo files are content-addressed, a name is counted only once
+            name = os.path.basename(path)
+            if not name in self.files:
+                size = self._fileSize(path)
+
+        with self._lock:
+            if docId in self.docs and self.docs[docId]==name: return
+            self._dropDoc(docId)
+            if not name is None and not name in self.files and size is None:
+                # no longer counted since, rare enough to stat here
+                size = self._fileSize(path)
+
+            if size is None and not name in self.files:
+                name = None
+            self.docs[docId] = name
+            if name is None: return
+            entry = self.files.get(name)
+            if entry is None:
+                self.files[name] = [size, 1]
+                self.size += size
+            else:
+                entry[1] += 1
+
+    def _fileSize(self, path):
+        try:
+            return os.stat(self.osPath(path)).st_size
+        except OSError:
+            return None
+
+    def _dropDoc(self, docId):
+        if not docId in self.docs: return
+        name = self.docs.pop(docId)
+        if name is None: return
+        entry = self.files[name]
+        entry[1] -= 1
+        if not entry[1]:
+            del self.files[name]
+            self.size -= entry[0]
+
+    def docsChanged(self, db, docIds):
+        '''
+        Counts the documents changed by other processes, and their PDFs,
+        dropping those deleted.
+        '''
+        with self._lock:
+            if not self.ready:
+                # the scan may have read them before the change
+                self._changed.update(docIds)
+        docs = dict((doc.doc_id, doc)
+                    for doc in db.get_docs(docIds, check_for_conflicts=False,
+                                           include_deleted=True))
+        for docId in docIds:
+            self._setDoc(docId, docs.get(docId))
+
+
 class PDFFile(FileObject):
     '''
     PDF File
     '''
+    # repo files never change, the page cache stays valid
+    KEEP_CACHE = True
+
     def __init__(self, name, osPath, parent):
         super(PDFFile, self).__init__(name, parent)
         self.osPath = osPath
+        self._stat = None
 
-        self.osfd = {} # map FUSE file descriptor to OS file descriptors
+        self.maps = {} # map FUSE file descriptor to MappedFile
 
     def getattr(self):
-        return Stat(self.osPath).toDict()
+        # repo files never change, their stat can be kept
+        if self._stat is None:
+            self._stat = Stat.fromPath(self.osPath).replace(
+                st_ino=inodeOf(self.parent.paper.doc_id, u'pdf'),
+                st_nlink=self.parent.nlink)
+        return self._stat.toDict()
 
     def open(self, flags):
-        osfd = os.open(self.osPath, flags)
+        # the repo is content-addressed, never write to it
+        if flags & (os.O_WRONLY|os.O_RDWR):
+            raise FuseOSError(EROFS)
+
+        mfile = self.fsys.mapFile(self.osPath)
         fh = self.fsys.newFileHandle(self)
-        self.osfd[fh] = osfd
+        self.maps[fh] = mfile
 
         return fh
 
     def read(self, fh, size, offset):
-        osfd = self.osfd[fh]
-        os.lseek(osfd, offset, os.SEEK_SET)
-        return os.read(osfd, size)
+        data = self.maps[fh].read(size, offset)
+        self.fsys.metrics.read(self.name, len(data))
+        return data
+
+    def readinto(self, fh, buf, offset):
+        size = self.maps[fh].readinto(buf, offset)
+        self.fsys.metrics.read(self.name, size)
+        return size
 
     def release(self, fh):
-        osfd = self.osfd[fh]
-        os.close(osfd)
-        del self.osfd[fh]
+        self.maps.pop(fh)
+        self.fsys.unmapFile(self.osPath)
 
-class JsonFile(FileObject):
-    ''' JsonFile
+    def xattrs(self):
+        return self.parent.xattrs()
+
+class PDFLink(FileObject):
     '''
-    def __init__(self, name, parent, stat=None):
-        if not isinstance(parent, DirPaper):
-            raise TypeError
-        super(JsonFile, self).__init__(name, parent)
+    PDF as a symbolic link to its file in the repo, so that viewers read
+    it from the underlying file system rather than through FUSE.
+    '''
+    def __init__(self, name, osPath, parent):
+        super(PDFLink, self).__init__(name, parent)
+        self.target = os.path.abspath(osPath)
+        self._stat = None
 
-        self.paper = parent.paper
-        self.data = self.paper.toJson().encode('utf-8')
-        self.digest = hash(self.data)
+    def getattr(self):
+        # repo files never change, their times can be kept
+        if self._stat is None:
+            st = os.stat(self.target)
+            self._stat = Stat(S_IFLNK|0777, len(senc(self.target)),
+                              st_nlink=self.parent.nlink,
+                              st_atime=st.st_atime, st_mtime=st.st_mtime,
+                              st_ctime=st.st_ctime,
+                              st_ino=inodeOf(self.parent.paper.doc_id, u'pdf'))
+        return self._stat.toDict()
 
-        if stat:
-            self.stat=stat
-        else:
-            self.stat=Stat(S_IFREG|0664, len(self.data), st_nlink=1)
+    def open(self, flags):
+        # the kernel follows the link, only O_NOFOLLOW opens end up here
+        raise FuseOSError(ELOOP)
+
+    def xattrs(self):
+        return self.parent.xattrs()
+
+class StatsFile(FileObject):
+    '''
+    Read-only report of the file system's metrics. Every open takes a
+    snapshot, which reads on that handle return.
+    '''
+    # the size is only known once opened
+    DIRECT_IO = True
+
+    def __init__(self, name, parent):
+        super(StatsFile, self).__init__(name, parent,
+                                        Stat(S_IFREG|0444, 0, st_nlink=1))
+        self.reports = {} # map FUSE file descriptor to its snapshot
 
     def getattr(self):
         return self.stat.toDict()
 
     def open(self, flags):
+        if flags & (os.O_WRONLY|os.O_RDWR):
+            raise FuseOSError(EROFS)
+
         fh = self.fsys.newFileHandle(self)
+        self.reports[fh] = self.fsys.metrics.report().encode('utf-8')
         return fh
 
     def read(self, fh, size, offset):
-        return self.data[offset:offset+size]
+        return self.reports[fh][offset:offset+size]
+
+    def release(self, fh):
+        self.reports.pop(fh, None)
+
+class BufferFile(FileObject):
+    '''
+    A file held in a bytearray, so that writes and truncates at any
+    offset take time linear in the data they touch.
+    '''
+    def __init__(self, name, parent, data='', stat=None):
+        super(BufferFile, self).__init__(name, parent, stat)
+
+        self.data = bytearray(data)
+        if not stat:
+            self.stat = Stat(S_IFREG|0664, len(self.data), st_nlink=1)
+
+    def cost(self):
+        return self.COST + len(self.data)
+
+    def getattr(self):
+        return self.stat.toDict()
+
+    def open(self, flags):
+        return self.fsys.newFileHandle(self)
+
+    def read(self, fh, size, offset):
+        return bytes(self.data[offset:offset+size])
 
     def truncate(self, fh, length):
-        self.data = self.data[:offset]
-        self.stat.st_size = len(self.data)
+        if length < len(self.data):
+            del self.data[length:]
+        else:
+            self.data.extend(bytearray(length - len(self.data)))
+        self.stat = self.stat.replace(st_size=length)
 
     def write(self, fh, data, offset):
-        self.data = self.data[:offset] + data
-        self.stat.st_size = len(self.data)
+        # writing past the end leaves a hole of zeros
+        if offset > len(self.data):
+            self.truncate(fh, offset)
+
+        self.data[offset:offset+len(data)] = data
+        if len(self.data)!=self.stat.st_size:
+            self.stat = self.stat.replace(st_size=len(self.data))
         return len(data)
 
+    def writefrom(self, fh, buf, offset):
+        # the bytearray copies straight out of the ctypes array
+        return self.write(fh, buf, offset)
+
     def release(self, fh):
-        digest = hash(self.data)
+        pass
+
+
+class JsonFile(BufferFile):
+    ''' JsonFile
+    '''
+    def __init__(self, name, parent, stat=None):
+        if not isinstance(parent, DirPaper):
+            raise TypeError
+
+        self.paper = parent.paper
+        data = self.paper.toJson().encode('utf-8')
+        super(JsonFile, self).__init__(name, parent, data, stat)
+        if not stat:
+            self.stat = self.stat.replace(
+                st_ino=inodeOf(self.paper.doc_id, u'json'),
+                st_nlink=parent.nlink)
+        self.digest = hash(data)
+
+    def release(self, fh):
+        self.commit()
+
+    def commit(self):
+        '''
+        Stores the paper, if the contents changed.
+        '''
+        data = bytes(self.data)
+        digest = hash(data)
         if digest==self.digest: return
 
         self.digest = digest
 
-        newPaper = DataModel.Paper.fromJson(self.data.decode('utf-8'))
+        newPaper = DataModel.Paper.fromJson(data.decode('utf-8'))
         self.fsys.modifyPaper(self.paper.doc_id, newPaper)
+        self.paper = self.parent.paper = newPaper
+
 
 
+# marks a path known not to exist in the dentry cache
+NEGATIVE = object()
 
-class PaperFS(LoggingMixIn, Operations):
+class PaperFS(Operations):
     'Example memory filesystem. Supports only one level of files.'
 
-    def __init__(self, repoDir):
+    # how often to look for changes made to the db by other processes
+    DB_CHECK_INTERVAL = 1.0
+
+    # number of keys after the listed offset of an index to prefetch
+    PREFETCH_KEYS = 64
+    # share of the directory cache's memory prefetching may fill
+    PREFETCH_MEM = 0.5
+
+    # metrics report in the root directory
+    STATS_NAME = u'.stats'
+
+    # how long statfs results are reused
+    STATFS_INTERVAL = 1.0
+
+    # sampled operations are logged here at DEBUG, see logOperations
+    opLog = logging.getLogger('paperfs.ops')
+    # operations whose return value is a byte count
+    SIZED_OPS = frozenset(['read', 'readinto', 'write', 'writefrom'])
+
+    def __init__(self, repoDir, cacheEntries=4096, cacheMem=64<<20,
+                 dentryEntries=16384, attrTimeout=5.0, entryTimeout=5.0,
+                 negativeTimeout=5.0, prefetchWorkers=2, linkPDFs=False,
+                 bucketPapers=0, bucketBy='year'):
         self.repoDir = repoDir
+        # serve PDFs as symbolic links into the repo instead of files
+        self.linkPDFs = linkPDFs
+        # search directories of more than bucketPapers papers list them
+        # in buckets by 'year' or by 'initial' of the first author; 0
+        # lists them all
+        self.bucketPapers = bucketPapers
+        self.bucketBy = bucketBy
+
+        # how long the kernel may cache attributes, names and missing names
+        self.attrTimeout = attrTimeout
+        self.entryTimeout = entryTimeout
+        self.negativeTimeout = negativeTimeout
+
+        # guards the directory tree
+        self.lock = threading.RLock()
+
+        self.handles = HandleTable()
+        # path -> DirObject, for directories resolved so far. Objects held
+        # open by a handle are never evicted.
+        self.dirCache = LRUCache(cacheEntries, cacheMem,
+                                 cost=lambda d: d.cost(),
+                                 pinned=lambda d: self.handles.refs(d)>0)
+        # full path -> NEGATIVE, for paths known not to exist
+        self.dentries = LRUCache(dentryEntries)
+
+        self.metrics = Metrics()
+        self.logOperations()
+
+        self.library = LibraryStats(repoDir)
+        self._statfs = (0, None)    # (time, statfs dict)
+        self.metrics.watchCache('directories', self.dirCache)
+        self.metrics.watchCache('dentries', self.dentries)
+
+        # populates the searches of listed index keys in the background
+        self.prefetcher = Prefetcher(prefetchWorkers)
+
+        # live search and index directories, to update on modifyPaper
+        self.searchDirs = weakref.WeakSet()
+        self.indexDirs = weakref.WeakSet()
+
+        self.mappedFiles = {}   # osPath -> MappedFile
+
+        # names of paper directories, shared by all listings
+        self.paperNames = PaperNames()
+
+        self.dbGeneration = 0
+        self.dbChecked = 0
+
+    def logOperations(self, sample=1.0):
+        '''
+        Logs one in every 1/sample operations to opLog, provided it is
+        enabled for DEBUG. Records carry op, path, size, latency and
+        errno as attributes; payloads are never formatted.
+        '''
+        self._logCount = 0
+        if sample>0 and self.opLog.isEnabledFor(logging.DEBUG):
+            self._logEvery = max(1, int(round(1.0/sample)))
+        else:
+            self._logEvery = 0
 
-        self.cntFH = 0
+    def __call__(self, op, path, *args):
+        t0 = time()
+        ret, err = None, None
+        try:
+            ret = super(PaperFS, self).__call__(op, path, *args)
+            return ret
+        except OSError, e:
+            err = e.errno or EFAULT
+            raise
+        except:
+            err = EFAULT
+            raise
+        finally:
+            latency = time() - t0
+            self.metrics.op(op, latency, not err is None)
+            if self._logEvery:
+                self._logOp(op, path, ret, latency, err)
+
+    def _logOp(self, op, path, ret, latency, err):
+        self._logCount += 1
+        if self._logCount % self._logEvery: return
+
+        size = None
+        if isinstance(ret, basestring):
+            size = len(ret)
+        elif op in self.SIZED_OPS:
+            size = ret
+        self.opLog.debug('%s %s size=%s latency=%.3fms errno=%s',
+                         op, path, size, latency*1e3, err,
+                         extra={'op': op, 'path': path, 'size': size,
+                                'latency': latency, 'errno': err})
+
+    def fuseOptions(self):
+        '''
+        Returns the mount options that set up kernel caching.
+        '''
+        return dict(attr_timeout=self.attrTimeout,
+                    entry_timeout=self.entryTimeout,
+                    negative_timeout=self.negativeTimeout,
+                    use_ino=True)
+
+    @staticmethod
+    def _withIno(path, attrs):
+        '''
+        Returns attrs, given an inode number derived from path if the
+        object has none of its own. Papers, their files and the keys
+        of indexes have theirs.
+        '''
+        if not attrs or attrs['st_ino']: return attrs
+        return dict(attrs, st_ino=inodeOf(u'path', path))
+
+    def _inodes(self, path, entries):
+        for name, attrs, offset in entries:
+            if name!='.':
+                fpath = os.path.join(path, name)
+            else:
+                fpath = path
+            yield name, self._withIno(fpath, attrs), offset
+
+    @staticmethod
+    def _fh(fi):
+        # mounted with raw_fi, fusepy passes fuse_file_info, not the handle
+        return getattr(fi, 'fh', fi)
 
     def _init_data(self):
-        self.mapPath = {}
-        self.mapHandle = {}
+        with self.lock:
+            self.dbGeneration = self.db._get_generation()
+            self.dbChecked = time()
+            self._build_tree()
+
+    def _build_tree(self):
+        self.dirCache.clear()
+        self.dentries.clear()
 
         root = DirSimple(u'Papers', parent=self)
-        self.mapPath['/'] = root
 
         search = AllPapers(self.db)
         dirAll = DirSearch(u'All Papers', parent=root, search=search)
@@ -621,6 +1921,10 @@ class PaperFS(LoggingMixIn, Operations):
                           index=IndexByTitle(self.db))
         root.appendChild(dirIdx)
 
+        dirIdx = DirIndex(u'By Year', parent=root,
+                          index=IndexByYear(self.db))
+        root.appendChild(dirIdx)
+
         # Tag Tree
         fntag = os.path.join(self.repoDir, 'tags.json')
         if os.path.exists(fntag):
@@ -630,90 +1934,204 @@ class PaperFS(LoggingMixIn, Operations):
         else:
             self.tagTree = DataModel.TagTree()
 
-        def makeTagTree(pDir, pparts, tree):
-            fulltag = ':'.join(pparts)
-            search = ByTag(self.db, fulltag.lower())
-            pDir.appendChild(DirSearch('All', parent=pDir, search=search))
-
-            for tag, subtree in tree.children():
-                parts = [tag] + pparts
-                fulltag = ':'.join(parts)
-
-                if subtree.childCount()==0:
-                    search = ByTag(self.db, fulltag.lower())
-                    pDir.appendChild(DirSearch(tag, parent=pDir, search=search))
-                else:
-                    cDir = DirSimple(tag, parent=pDir)
-                    pDir.appendChild(cDir)
-                    makeTagTree(cDir, parts, subtree)
-        dirIdx = DirSimple(u'By Tags', parent=root)
-        makeTagTree(dirIdx, [], self.tagTree)
+        dirIdx = DirTags(u'By Tags', parent=root, tree=self.tagTree)
 
         #dirIdx = DirIndex(u'By Tags', parent=root,
         #                  index=IndexByTag(self.db))
         root.appendChild(dirIdx)
+
+        root.appendChild(StatsFile(self.STATS_NAME, parent=root))
         self.root = root
 
     def init(self, path):
-        self.db = u1db.open(os.path.join(self.repoDir, 'papers.u1db'),
-                            create=False)
+        # each FUSE worker thread gets its own u1db connection
+        self.db = ThreadLocalDB(os.path.join(self.repoDir, 'papers.u1db'))
+        ensureIndexes(self.db)
         self._init_data()
-
-    def newFileHandle(self, obj=None):
-        fh = self.cntFH
-        if not obj is None:
-            self.mapHandle[fh] = obj
-        self.cntFH += 1
-        return fh
+        self.prefetcher.start()
+        self.library.start(self.db)
+        self.paperNames.start(self.db)
+
+    def destroy(self, path):
+        self.prefetcher.stop()
+        self.db.close()
+
+    def newFileHandle(self, obj):
+        return self.handles.open(obj)
+
+    def mapFile(self, osPath):
+        '''
+        Returns the MappedFile of osPath, shared with the other handles
+        open on it. Each call must be paired with unmapFile.
+        '''
+        with self.lock:
+            mfile = self.mappedFiles.get(osPath)
+            if mfile is None:
+                mfile = MappedFile(osPath)
+                self.mappedFiles[osPath] = mfile
+            mfile.refs += 1
+            return mfile
+
+    def unmapFile(self, osPath):
+        with self.lock:
+            mfile = self.mappedFiles[osPath]
+            mfile.refs -= 1
+            if mfile.refs==0:
+                del self.mappedFiles[osPath]
+                mfile.close()
 
     def modifyPaper(self, doc_id, paper):
-        doc = self.db.get_doc(doc_id)
-        doc.content = paper.toDict()
-        self.db.put_doc(doc)
-
-        self._init_data()
-
-    def _search_path(self, path):
-        pname, fname, fsobj = path, '', None
-
-        fsobj = self.mapPath.get(pname)
-        if fsobj is None:
-            pname, fname = os.path.split(pname)
-            fsobj = self.mapPath.get(pname)
-
-        return fsobj, fname
+        # the json of a paper carries no doc_id, whoever holds the paper
+        # next needs it to store it again
+        paper.doc_id = doc_id
+        with self.lock:
+            doc = self.db.get_doc(doc_id)
+            oldContent = doc.content
+            doc.content = paper.toDict()
+            self.db.put_doc(doc)
+
+            gen, _, changes = self.db.whats_changed(self.dbGeneration)
+            self.dbGeneration = gen
+            others = [c[0] for c in changes if c[0]!=doc_id]
+            if others:
+                # other processes changed the db as well
+                self.library.docsChanged(self.db, others)
+                self.paperNames.docsChanged(self.db, [c[0] for c in changes])
+                self._init_data()
+            else:
+                self._paperChanged(paper, oldContent, doc.content)
+
+    def _paperChanged(self, paper, oldContent, newContent):
+        '''
+        Updates the directories affected by a modified paper, leaving the
+        rest of the tree and all open handles alone.
+        '''
+        oldKeys, newKeys = indexKeys(oldContent), indexKeys(newContent)
+        # papers sharing its old or new name may be renamed along with it
+        renamed = self.paperNames.update(paper.doc_id,
+                                         PaperNames.baseOf(paper))
+
+        stale = set(d for d in list(self.searchDirs)
+                    if d.paperChanged(paper, oldKeys, newKeys) or
+                       d.namesChanged(renamed))
+        for dirIndex in list(self.indexDirs):
+            dirIndex.keysChanged(oldKeys, newKeys)
+
+        def isStale(path, dobj):
+            if dobj.parent in stale:
+                return True
+            elif isinstance(dobj, DirPaper):
+                return dobj.paper.doc_id==paper.doc_id
+            elif isinstance(dobj.parent, DirIndex):
+                return not dobj.parent.hasEntry(dobj.name)
+            return False
+        self.dirCache.popIf(isStale)
+        self.dentries.clear()
+
+    def _checkDB(self):
+        '''
+        Rebuilds the tree if other processes changed the db, looking at
+        most once every DB_CHECK_INTERVAL seconds.
+        '''
+        now = time()
+        if now - self.dbChecked < self.DB_CHECK_INTERVAL: return
+        self.dbChecked = now
+
+        _, _, changes = self.db.whats_changed(self.dbGeneration)
+        if changes:
+            docIds = [c[0] for c in changes]
+            self.library.docsChanged(self.db, docIds)
+            self.paperNames.docsChanged(self.db, docIds)
+            self._init_data()
+
+    def _lookup(self, path):
+        '''
+        Resolves the path of a directory to its DirObject, or None.
+        '''
+        if path=='/': return self.root
+
+        dobj = self.dirCache.get(path)
+        if not dobj is None: return dobj
+        if self.dentries.get(path) is NEGATIVE: return None
+
+        pname, fname = os.path.split(path)
+        parent = self._lookup(pname)
+        if parent is None: return None
+
+        dobj = parent.lookup(fname)
+        if not dobj is None:
+            self.dirCache.put(path, dobj)
+        return dobj
 
     def opendir(self, path):
-        if path in self.mapPath:
-            return self.mapPath[path].fh
+        self._checkDB()
+        dobj = self._lookup(path)
+        if dobj is None:
+            raise FuseOSError(ENOENT)
 
-        fsobj, fname = self._search_path(path)
-        if isinstance(fsobj, FSObject):
-            fh = fsobj.opendir(fname)
-            dobj = self.mapHandle.get(fh)
-            if not dobj is None:
-                self.mapPath[path] = dobj
-            return fh
+        return self.handles.open(dobj)
 
-        raise FuseOSError(ENOENT)
-
-    #def releasedir(self, path, fh):
-    #    del self.mapHandle[fh]
+    def releasedir(self, path, fh):
+        self.handles.release(fh)
 
     def readdir(self, path, fh=None):
         if fh is None:
-            fsobj, fname = self._search_path(path)
+            dobj = self._lookup(path)
         else:
-            fsobj, fname = self.mapHandle.get(fh), None
+            dobj = self.handles.get(fh)
+
+        if isinstance(dobj, DirIndex):
+            self._prefetch(path, dobj, 0)
+        if isinstance(dobj, DirObject):
+            return self._inodes(path, dobj.readdir())
 
-        if isinstance(fsobj, DirObject):
-            return fsobj.readdir()
+    def readdirfrom(self, path, offset, fh=None):
+        if fh is None:
+            dobj = self._lookup(path)
+        else:
+            dobj = self.handles.get(fh)
+
+        if isinstance(dobj, DirIndex):
+            self._prefetch(path, dobj, offset)
+        if isinstance(dobj, DirObject):
+            return self._inodes(path, dobj.readdirFrom(offset))
+
+    def _prefetchRoom(self):
+        maxCost = self.dirCache.maxCost
+        return maxCost is None or \
+               self.dirCache.totalCost < maxCost*self.PREFETCH_MEM
+
+    def _prefetch(self, path, dobj, offset):
+        '''
+        Queues the searches of the index keys listed from offset on, so
+        they are ready by the time they are opened.
+        '''
+        # offsets count . and .. first
+        start = max(offset-2, 0)
+        for key in dobj.listedKeys()[start:start+self.PREFETCH_KEYS]:
+            if key is None: continue    # a shard, no search to run
+            kpath = os.path.join(path, key)
+            if kpath in self.dirCache: continue
+            if not self._prefetchRoom(): return
+
+            def job(kpath=kpath):
+                if not self._prefetchRoom(): return
+                sobj = self._lookup(kpath)
+                if isinstance(sobj, DirSearch):
+                    sobj.prefetch()
+                    # it was cached while still empty, count what it holds
+                    # now so that the budget sees it
+                    self.dirCache.recost(kpath)
+            if not self.prefetcher.submit(kpath, job): return
 
     def mkdir(self, path, mode):
-        fsobj, fname = self._search_path(path)
+        pname, fname = os.path.split(path)
+        dobj = self._lookup(pname)
 
-        if isinstance(fsobj, DirSimple):
-            fsobj.mkdir(fname)
+        if isinstance(dobj, DirSimple):
+            with self.lock:
+                dobj.mkdir(fname)
+                self.dentries.pop(path)
 
 
     def rename(self, old, new):
@@ -722,83 +2140,262 @@ class PaperFS(LoggingMixIn, Operations):
         if not opname==npname:
             raise ValueError
 
-        fsobj, _ = self._search_path(opname)
-        if isinstance(fsobj, DirSimple):
-            if self.mapPath.has_key(old):
-                del self.mapPath[old]
-            fsobj.rename(ofname, nfname)
+        dobj = self._lookup(opname)
+        if isinstance(dobj, DirSimple):
+            with self.lock:
+                dobj.rename(ofname, nfname)
+                for p in (old, new):
+                    inside = lambda q, _: q==p or q.startswith(p+'/')
+                    self.dirCache.popIf(inside)
+                    self.dentries.popIf(inside)
+            return
+        elif isinstance(dobj, DirPaper):
+            with self.lock:
+                dobj.rename(ofname, nfname)
+                self.dentries.pop(new)
             return
 
         raise FuseOSError(ENOENT)
 
-    def getattr(self, path, fh=None):
-        fsobj, fname = None, None
-        if fh is None:
-            pname, fname = os.path.split(path)
-            fh = self.opendir(pname)
+    def create(self, path, mode, fi=None):
+        pname, fname = os.path.split(path)
+        dobj = self._lookup(pname)
+        if not isinstance(dobj, DirPaper):
+            raise FuseOSError(EPERM)
+
+        flags = getattr(fi, 'flags', os.O_WRONLY)
+        with self.lock:
+            fh = dobj.create(fname, flags)
+            self.dentries.pop(path)
+        if fi is None:
+            return fh   # mounted without raw_fi
+
+        fi.fh = fh
+        return 0
+
+    def unlink(self, path):
+        pname, fname = os.path.split(path)
+        dobj = self._lookup(pname)
+        if not isinstance(dobj, DirPaper):
+            raise FuseOSError(ENOENT)
+
+        with self.lock:
+            dobj.unlink(fname)
+
+    def statfs(self, path):
+        '''
+        Reports the repo store as used space and the documents as used
+        inodes, next to what is free on the disk holding the repo.
+        '''
+        t, st = self._statfs
+        now = time()
+        if not st is None and now - t < self.STATFS_INTERVAL:
+            return st
+
+        vfs = os.statvfs(self.repoDir)
+        bsize = vfs.f_frsize or vfs.f_bsize
+        used = (self.library.size + bsize - 1)//bsize
+        st = dict(f_bsize=vfs.f_bsize, f_frsize=bsize,
+                  f_blocks=used + vfs.f_bavail,
+                  f_bfree=vfs.f_bavail, f_bavail=vfs.f_bavail,
+                  f_files=len(self.library.docs) + vfs.f_favail,
+                  f_ffree=vfs.f_favail, f_favail=vfs.f_favail,
+                  f_namemax=255)
+        self._statfs = (now, st)
+        return st
+
+    def _xattrs(self, path):
+        dobj = self._lookup(path)
+        if not dobj is None:
+            return dobj.xattrs()
+
+        pname, fname = os.path.split(path)
+        dobj = self._lookup(pname)
+        if isinstance(dobj, DirPaper):
+            return dobj.file(fname).xattrs()
+        elif isinstance(dobj, DirObject):
+            dobj.getattr(fname)     # ENOENT unless it exists
+            return {}
+        raise FuseOSError(ENOENT)
 
-        fsobj = self.mapHandle.get(fh)
+    def getxattr(self, path, name, position=0):
+        value = self._xattrs(path).get(name)
+        if value is None:
+            raise FuseOSError(ENODATA)
+        return value
 
-        if isinstance(fsobj, FSObject):
-            if fname:
-                return fsobj.getattr(fname)
-            else:
+    def listxattr(self, path):
+        return sorted(self._xattrs(path))
+
+    def getattr(self, path, fh=None):
+        return self._withIno(path, self._getattr(path, fh))
+
+    def _getattr(self, path, fh):
+        if not fh is None:
+            fsobj = self.handles.get(self._fh(fh))
+            if isinstance(fsobj, FSObject):
                 return fsobj.getattr()
 
-        raise FuseOSError(ENOENT)
+        self._checkDB()
+        if self.dentries.get(path) is NEGATIVE:
+            raise FuseOSError(ENOENT)
 
+        # the parent comes out of dirCache, only misses are remembered
+        pname, fname = os.path.split(path)
+        if not fname:
+            return self.root.getattr()
 
-    def open(self, path, flags):
-        fsobj, fname = self._search_path(path)
+        dobj = self._lookup(pname)
+        try:
+            if not isinstance(dobj, DirObject):
+                raise FuseOSError(ENOENT)
+            attrs = dobj.getattr(fname)
+        except FuseOSError, e:
+            if e.errno==ENOENT:
+                self.dentries.put(path, NEGATIVE)
+            raise
+        return attrs
+
+    def readlink(self, path):
+        pname, fname = os.path.split(path)
+        dobj = self._lookup(pname)
+        if not isinstance(dobj, DirObject):
+            raise FuseOSError(ENOENT)
+        return dobj.readlink(fname)
 
-        if isinstance(fsobj, FSObject):
-            if fname:
-                fh = fsobj.open(fname, flags)
-            else:
-                fh = fsobj.open(flags)
 
-            fobj = self.mapHandle.get(fh)
-            if fobj:
-                self.mapPath[path] = fobj
-            return fh
+    def open(self, path, fi):
+        pname, fname = os.path.split(path)
+        dobj = self._lookup(pname)
+        if not isinstance(dobj, DirObject):
+            raise FuseOSError(ENOENT)
 
-        raise FuseOSError(ENOENT)
+        flags = getattr(fi, 'flags', fi)
+        fh = dobj.open(fname, flags)
+        if fi is flags:
+            return fh   # mounted without raw_fi
+
+        fobj = self.handles.get(fh)
+        fi.fh = fh
+        fi.keep_cache = fobj.KEEP_CACHE
+        fi.direct_io = fobj.DIRECT_IO
+        return 0
 
     def release(self, path, fh):
-        fobj = self.mapHandle.get(fh)
-        if isinstance(fobj, FileObject):
-            fobj.release(fh)
-            if self.mapHandle.has_key(fh):
-                del self.mapHandle[fh]
+        fh = self._fh(fh)
+        fobj = self.handles.get(fh)
+        try:
+            if isinstance(fobj, FileObject):
+                fobj.release(fh)
+        finally:
+            self.handles.release(fh)
 
     def read(self, path, size, offset, fh):
-        fobj = self.mapHandle.get(fh)
+        fh = self._fh(fh)
+        fobj = self.handles.get(fh)
 
         if isinstance(fobj, FSObject):
             return fobj.read(fh, size, offset)
 
         raise FuseOSError(ENOENT)
 
+    def readinto(self, path, buf, offset, fh):
+        fh = self._fh(fh)
+        fobj = self.handles.get(fh)
+
+        if isinstance(fobj, FileObject):
+            return fobj.readinto(fh, buf, offset)
+
+        raise FuseOSError(ENOENT)
+
+    def writefrom(self, path, buf, offset, fh):
+        fh = self._fh(fh)
+        fobj = self.handles.get(fh)
+
+        if isinstance(fobj, FileObject):
+            with self.lock:
+                return fobj.writefrom(fh, buf, offset)
+
+        raise FuseOSError(ENOENT)
+
     def write(self, path, data, offset, fh):
-        fobj = self.mapHandle.get(fh)
+        fh = self._fh(fh)
+        fobj = self.handles.get(fh)
 
         if isinstance(fobj, FSObject):
-            return fobj.write(fh, data, offset)
+            with self.lock:
+                return fobj.write(fh, data, offset)
 
         raise FuseOSError(ENOENT)
 
     def truncate(self, path, length, fh=None):
-        fobj = self.mapHandle.get(fh)
+        fh = self._fh(fh)
+        fobj = self.handles.get(fh)
 
         if isinstance(fobj, FSObject):
-            fobj.truncate(fh, length)
+            with self.lock:
+                return fobj.truncate(fh, length)
+
+        # truncate(2) on a path, or open with O_TRUNC
+        pname, fname = os.path.split(path)
+        dobj = self._lookup(pname)
+        if not isinstance(dobj, DirPaper):
+            raise FuseOSError(ENOENT)
+
+        with self.lock:
+            dobj.truncate(fname, length)
 
 if __name__ == '__main__':
-    if len(argv) != 2:
-        print('usage: %s <mountpoint>' % argv[0])
-        exit(1)
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Mount the paper library '
+                                     'in the current directory.')
+    parser.add_argument('mountpoint')
+    parser.add_argument('-t', '--threads', action='store_true',
+                        help='serve requests from multiple threads')
+    parser.add_argument('--cache-entries', type=int, default=4096,
+                        help='maximum number of cached directories')
+    parser.add_argument('--cache-mem', type=int, default=64,
+                        help='memory budget of the directory cache, in MiB')
+    parser.add_argument('--attr-timeout', type=float, default=5.0,
+                        help='seconds the kernel may cache attributes')
+    parser.add_argument('--entry-timeout', type=float, default=5.0,
+                        help='seconds the kernel may cache names')
+    parser.add_argument('--negative-timeout', type=float, default=5.0,
+                        help='seconds the kernel may cache missing names')
+    parser.add_argument('--prefetch', type=int, default=2, metavar='N',
+                        help='threads populating listed index entries in '
+                        'the background, 0 to disable')
+    parser.add_argument('--link-pdfs', action='store_true',
+                        help='show PDFs as symbolic links into the repo, '
+                        'so they are read without going through FUSE')
+    parser.add_argument('--bucket', type=int, default=0, metavar='N',
+                        help='split search folders of more than N papers '
+                        'into sub-folders, 0 to never split')
+    parser.add_argument('--bucket-by', default='year',
+                        choices=['year', 'initial'],
+                        help='split by year or by first author initial')
+    parser.add_argument('--log-level', default='warning',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        help='operations are logged at debug level')
+    parser.add_argument('--log-sample', type=float, default=1.0,
+                        metavar='RATE',
+                        help='share of operations logged, e.g. 0.01')
+    args = parser.parse_args()
 
     repoDir = os.getcwd()
-    logging.getLogger().setLevel(logging.DEBUG)
-    fuse = FUSE(PaperFS(repoDir), argv[1], foreground=True, nothreads=True, fsname=u'Papers')
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+    paperfs = PaperFS(repoDir, cacheEntries=args.cache_entries,
+                      cacheMem=args.cache_mem<<20,
+                      attrTimeout=args.attr_timeout,
+                      entryTimeout=args.entry_timeout,
+                      negativeTimeout=args.negative_timeout,
+                      prefetchWorkers=args.prefetch,
+                      linkPDFs=args.link_pdfs,
+                      bucketPapers=args.bucket, bucketBy=args.bucket_by)
+    paperfs.logOperations(args.log_sample)
+    fuse = FUSE(paperfs, args.mountpoint, raw_fi=True, foreground=True,
+                nothreads=not args.threads, fsname=u'Papers',
+                **paperfs.fuseOptions())
+
 
@@ -1,13 +1,128 @@
-__all__=['Search', 'AllPapers', 'ByAuthorName', 'ByTag', 'ByTitleWords',
-         'IndexByTitle', 'IndexByAuthor', 'IndexByTag']
+__all__=['ThreadLocalDB', 'ensureIndexes', 'indexKeys', 'Search', 'AllPapers',
+         'ByAuthorName', 'ByTag', 'ByTitleWords', 'ByYear', 'IndexByTitle',
+         'IndexByAuthor', 'IndexByTag', 'IndexByYear', 'QueryError', 'Query']
 
+import re
+import thread, threading
+from time import time
 import u1db
 import DataModel
 
+class ThreadLocalDB(object):
+    '''
+    Proxy to a u1db database that opens one connection per thread.
+
+    The sqlite backend of u1db refuses to use a connection from a thread
+    other than the one that opened it, so a multithreaded mount cannot
+    share a single u1db.Database object.
+
+    Connections are keyed on the thread id rather than kept in a
+    threading.local: libfuse calls back from threads Python did not
+    start, which get a fresh thread state, and so fresh thread locals,
+    on every call.
+
+    libfuse also lets idle worker threads exit without telling anyone,
+    so a connection left unused for IDLE seconds is dropped whenever
+    another one is opened; sqlite closes it as it is freed. A thread
+    that was merely idle opens a new one.
+    '''
+    IDLE = 300.0
+
+    def __init__(self, path):
+        self.path = path
+        self._dbs = {}      # thread id -> [u1db.Database, time last used]
+        self._lock = threading.Lock()
+
+    def _db(self):
+        ident = thread.get_ident()
+        now = time()
+        entry = self._dbs.get(ident)
+        if entry is None:
+            entry = [u1db.open(self.path, create=False), now]
+            with self._lock:
+                self._prune(now)
+                self._dbs[ident] = entry
+        entry[1] = now
+        return entry[0]
+
+    def _prune(self, now):
+        for ident, (_, used) in self._dbs.items():
+            if now - used > self.IDLE:
+                del self._dbs[ident]
+
+    def __getattr__(self, name):
+        return getattr(self._db(), name)
+
+    def close(self):
+        '''
+        Closes the connections of all threads.
+        '''
+        with self._lock:
+            dbs, self._dbs = [e[0] for e in self._dbs.values()], {}
+        for db in dbs:
+            try:
+                db.close()
+            except Exception:
+                # sqlite may refuse to close another thread's connection,
+                # it is freed with the object then
+                pass
+
+# indexes the searches need beyond those created by importMacPapers.py.
+# u1db only indexes strings, years are indexed as zero padded numbers.
+INDEXES = {'by-year-number': 'number(year, 4)'}
+
+def ensureIndexes(db):
+    '''
+    Creates the INDEXES missing from db.
+    '''
+    have = set(name for name, _ in db.list_indexes())
+    for name, expression in INDEXES.iteritems():
+        if not name in have:
+            db.create_index(name, expression)
+
+def _strings(val):
+    if isinstance(val, basestring):
+        return [val]
+    elif isinstance(val, list):
+        return [v for v in val if isinstance(v, basestring)]
+    return []
+
+def indexKeys(content):
+    '''
+    Returns the values a document dict has in each index, as a dict of
+    index name -> set of values. Mirrors the index expressions created by
+    importMacPapers.py, so changes can be matched against searches without
+    asking u1db.
+    '''
+    if content is None: content = {}
+
+    authors = content.get('authors')
+    lastnames = []
+    if isinstance(authors, list):
+        lastnames = [a.get('lastname') for a in authors if isinstance(a, dict)]
+
+    keys = {}
+    keys['by-author-name'] = set(w for s in _strings(authors)+_strings(lastnames)
+                                   for w in s.lower().split())
+    keys['by-title-words'] = set(w for s in _strings(content.get('title'))
+                                   for w in s.lower().split())
+    keys['by-tags'] = set(s.lower() for s in _strings(content.get('tags')))
+
+    year = content.get('year')
+    keys['by-year-number'] = set()
+    if isinstance(year, (int, long)) and not isinstance(year, bool):
+        keys['by-year-number'].add('%04d' % year)
+    return keys
+
 class Search(object):
+    # name of the index searched, None if not backed by a single index
+    INDEX = None
+
     def __init__(self, db):
         self.db = db
         self._papers = None
+        # seconds taken by each db query run, for the caller to collect
+        self.queryTimes = []
 
     def execute(self):
         if not self._papers is None: return
@@ -15,26 +130,81 @@ class Search(object):
     def papers(self):
         return self._papers
 
+    def pages(self, size):
+        '''
+        Yields the result as lists of at most size papers. Searches that
+        can fetch documents piecemeal override this, so that the first
+        page does not wait for the whole result.
+        '''
+        t0 = time()
+        self.execute()
+        self.queryTimes.append(time() - t0)
+
+        papers = self.papers()
+        for i in xrange(0, len(papers), size):
+            yield papers[i:i+size]
+
+    def matches(self, keys):
+        '''
+        Tells whether a document with the given indexKeys() could be in
+        the result. Errs on the side of True.
+        '''
+        if self.INDEX is None: return True
+
+        key = self.key
+        if key.endswith('*'):
+            key = key[:-1]
+            return any(k.startswith(key) for k in keys.get(self.INDEX, ()))
+        return key in keys.get(self.INDEX, ())
+
     def _docs2papers(self, docs):
-        self._papers = []
+        self._papers = self._toPapers(docs)
+
+    @staticmethod
+    def _toPapers(docs):
+        papers = []
         for doc in docs:
             if not isinstance(doc, u1db.Document): continue
 
             paper = DataModel.Paper.fromDict(doc.content)
             paper.doc_id = doc.doc_id
-            self._papers.append(paper)
+            papers.append(paper)
+        return papers
 
 class Index(object):
+    INDEX = None
+
     def __init__(self, db):
-        if not isinstance(db, u1db.Database):
+        if not isinstance(db, (u1db.Database, ThreadLocalDB)):
             raise TypeError
 
         self.db = db
-        self._keys = []
+        self._keys = None
 
     def keys(self):
+        '''
+        Returns the keys of the index, read from the db when first asked
+        for rather than at mount.
+        '''
+        if self._keys is None:
+            self._keys = self._loadKeys()
         return self._keys
 
+    def _loadKeys(self):
+        return [k for k, in self.db.get_index_keys(self.INDEX)]
+
+    def hasKey(self, key):
+        '''
+        Asks the db whether any document still has key in this index.
+        '''
+        return len(self.db.get_from_index(self.INDEX, key))>0
+
+    def bucket(self, value):
+        '''
+        Returns the key a value of the index is listed under.
+        '''
+        return value
+
     def get(self, key):
         return None
 
@@ -48,7 +218,24 @@ class AllPapers(Search):
         _, docs = self.db.get_all_docs()
         self._docs2papers(docs)
 
+    def pages(self, size):
+        # the change log lists every document id without loading contents
+        t0 = time()
+        _, _, changes = self.db.whats_changed(0)
+        ids = [doc_id for doc_id, _, _ in changes]
+        self.queryTimes.append(time() - t0)
+
+        for i in xrange(0, len(ids), size):
+            t0 = time()
+            # get_docs may load lazily, time it up to the last paper
+            papers = self._toPapers(self.db.get_docs(
+                ids[i:i+size], check_for_conflicts=False))
+            self.queryTimes.append(time() - t0)
+            yield papers
+
 class ByTitleWords(Search):
+    INDEX = 'by-title-words'
+
     def __init__(self, db, key):
         super(ByTitleWords, self).__init__(db)
 
@@ -60,16 +247,17 @@ class ByTitleWords(Search):
         self._docs2papers(docs)
 
 class IndexByTitle(Index):
+    INDEX = 'by-title-words'
+
     def __init__(self, db):
         super(IndexByTitle, self).__init__(db)
-        self._keys = []
-        for k, in db.get_index_keys('by-title-words'):
-            self._keys.append(k)
 
     def get(self, key):
         return ByTitleWords(self.db, key)
 
 class ByAuthorName(Search):
+    INDEX = 'by-author-name'
+
     def __init__(self, db, key):
         super(ByAuthorName, self).__init__(db)
 
@@ -81,17 +269,18 @@ class ByAuthorName(Search):
         self._docs2papers(docs)
 
 class IndexByAuthor(Index):
+    INDEX = 'by-author-name'
+
     def __init__(self, db):
         super(IndexByAuthor, self).__init__(db)
-        self._keys = []
-        for k, in db.get_index_keys('by-author-name'):
-            self._keys.append(k)
 
     def get(self, key):
         return ByAuthorName(self.db, key)
 
 
 class ByTag(Search):
+    INDEX = 'by-tags'
+
     def __init__(self, db, key):
         super(ByTag, self).__init__(db)
         self.key = key
@@ -102,12 +291,256 @@ class ByTag(Search):
         self._docs2papers(docs)
 
 class IndexByTag(Index):
+    INDEX = 'by-tags'
+
     def __init__(self, db):
         super(IndexByTag, self).__init__(db)
-        self._keys = []
-        for k, in db.get_index_keys('by-tags'):
-            self._keys.append(k)
 
     def get(self, key):
         return ByTag(self.db, key)
 
+
+
+class ByYear(Search):
+    INDEX = 'by-year-number'
+
+    def __init__(self, db, low, high=None):
+        super(ByYear, self).__init__(db)
+
+        self.low = low
+        self.high = low if high is None else high
+
+    def execute(self):
+        low, high = '%04d' % self.low, '%04d' % self.high
+        if low==high:
+            docs = self.db.get_from_index(self.INDEX, low)
+        else:
+            docs = self.db.get_range_from_index(self.INDEX, low, high)
+        self._docs2papers(docs)
+        self._papers.sort(key=lambda p: p.year)
+
+    def matches(self, keys):
+        return any(self.low<=int(k)<=self.high
+                   for k in keys.get(self.INDEX, ()))
+
+class IndexByYear(Index):
+    '''
+    Years in buckets of span years, named after their first year: 1990s
+    for decades, or just 1995 if span is 1.
+    '''
+    INDEX = 'by-year-number'
+
+    def __init__(self, db, span=10):
+        super(IndexByYear, self).__init__(db)
+        self.span = span
+
+    def _loadKeys(self):
+        return sorted(set(self.bucket(k)
+                          for k, in self.db.get_index_keys(self.INDEX)))
+
+    def bucket(self, value):
+        start = int(value)//self.span*self.span
+        if self.span==1:
+            return u'%04d' % start
+        return u'%04ds' % start
+
+    def _range(self, key):
+        start = int(key.rstrip('s'))
+        return start, start + self.span - 1
+
+    def hasKey(self, key):
+        low, high = self._range(key)
+        return len(self.db.get_range_from_index(self.INDEX, '%04d' % low,
+                                                '%04d' % high))>0
+
+    def get(self, key):
+        return ByYear(self.db, *self._range(key))
+
+
+class QueryError(ValueError):
+    pass
+
+class Query(Search):
+    '''
+    A boolean query over the indexes, as typed into a directory name:
+
+        author:smith tag:bayesian year:2005..2012
+        (title:graph* OR title:network) -tag:review
+
+    Terms are field:value, with field one of author, title, tag or year;
+    a bare value is looked up in author, title and tag. A value ending
+    in * matches as a prefix, and year takes ranges such as 2005..2012,
+    2005.. or ..2012. Terms next to each other must all match; OR, NOT
+    (or a leading -, also before a parenthesis) and parentheses combine
+    them otherwise.
+
+    Every term fetches the documents of its index keys, and only their
+    ids take part in the set operations: intersections start from the
+    smallest set, and papers are made only of the final hits.
+    '''
+    FIELDS = {'author': 'by-author-name',
+              'title':  'by-title-words',
+              'tag':    'by-tags',
+              'year':   'by-year-number'}
+    # indexes a bare value is looked up in
+    BARE = ('author', 'title', 'tag')
+
+    # -( is a negated group, a - elsewhere is part of its word
+    TOKENS = re.compile(r'-\(|\(|\)|[^\s()]+')
+
+    def __init__(self, db, text):
+        super(Query, self).__init__(db)
+        self.text = text
+        self._tokens = self.TOKENS.findall(text)
+        self.tree = self._parseOr()
+        if self._tokens:
+            raise QueryError('unexpected %r' % self._tokens[0])
+        del self._tokens
+
+    @classmethod
+    def isQuery(cls, text):
+        '''
+        Tells whether text is meant as a query: it has a field:value term
+        or an operator. Parentheses alone do not count, so plain names such
+        as "New Folder" or "New Folder (2)" are not.
+        '''
+        for token in cls.TOKENS.findall(text):
+            if token in ('OR', 'NOT'):
+                return True
+            elif token.startswith('-') and len(token)>1:
+                return True
+            elif token.split(':', 1)[0] in cls.FIELDS and ':' in token:
+                return True
+        return False
+
+    # the parser turns the text into a tree of tuples:
+    #   ('and', [nodes]), ('or', [nodes]), ('not', node),
+    #   ('key', index, value), ('range', index, low, high)
+    def _next(self):
+        return self._tokens[0] if self._tokens else None
+
+    def _parseOr(self):
+        nodes = [self._parseAnd()]
+        while self._next()=='OR':
+            self._tokens.pop(0)
+            nodes.append(self._parseAnd())
+        return nodes[0] if len(nodes)==1 else ('or', nodes)
+
+    def _parseAnd(self):
+        nodes = []
+        while not self._next() in (None, ')', 'OR'):
+            if self._next()=='AND':
+                self._tokens.pop(0)
+                continue
+            nodes.append(self._parseNot())
+        if not nodes:
+            raise QueryError('missing term in %r' % self.text)
+        return nodes[0] if len(nodes)==1 else ('and', nodes)
+
+    def _parseNot(self):
+        token = self._tokens.pop(0)
+        if token=='NOT':
+            if self._next() is None: raise QueryError('missing term after NOT')
+            return ('not', self._parseNot())
+        elif token.startswith('-') and len(token)>1:
+            self._tokens.insert(0, token[1:])
+            return ('not', self._parseNot())
+        elif token=='-':
+            raise QueryError('missing term after -')
+        elif token=='(':
+            node = self._parseOr()
+            if self._next()!=')': raise QueryError('missing )')
+            self._tokens.pop(0)
+            return node
+        elif token==')':
+            raise QueryError('unexpected )')
+        return self._parseTerm(token)
+
+    def _parseTerm(self, token):
+        field, sep, value = token.partition(':')
+        if not sep:
+            return ('or', [self._parseTerm('%s:%s' % (f, token))
+                           for f in self.BARE])
+
+        field, value = field.lower(), value.lower()
+        if not field in self.FIELDS or not value:
+            raise QueryError('bad term %r' % token)
+        if '*' in value[:-1]:
+            raise QueryError('* only ends a prefix, not %r' % token)
+        index = self.FIELDS[field]
+
+        if field=='year':
+            low, dots, high = value.partition('..')
+            try:
+                low  = '%04d' % int(low) if low else None
+                high = '%04d' % int(high) if high else None
+            except ValueError:
+                raise QueryError('bad year %r' % value)
+            if not dots:
+                return ('key', index, low)
+            return ('range', index, low, high)
+        return ('key', index, value)
+
+    def _docs(self, node):
+        '''
+        Returns the documents matching node, as a dict doc_id -> doc.
+        '''
+        op = node[0]
+        if op=='key':
+            docs = self.db.get_from_index(node[1], node[2])
+        elif op=='range':
+            docs = self.db.get_range_from_index(node[1], node[2], node[3])
+        elif op=='or':
+            result = {}
+            for child in node[1]:
+                result.update(self._docs(child))
+            return result
+        elif op=='and':
+            pos = [self._docs(n) for n in node[1] if n[0]!='not']
+            neg = [self._docs(n[1]) for n in node[1] if n[0]=='not']
+            if not pos:
+                pos = [self._docs(('all',))]
+
+            pos.sort(key=len)
+            result = pos[0]
+            for other in pos[1:]:
+                if not result: break
+                result = dict((k, d) for k, d in result.iteritems()
+                              if k in other)
+            for other in neg:
+                result = dict((k, d) for k, d in result.iteritems()
+                              if not k in other)
+            return result
+        elif op=='not':
+            return self._docs(('and', [node]))
+        elif op=='all':
+            _, docs = self.db.get_all_docs()
+
+        return dict((doc.doc_id, doc) for doc in docs)
+
+    def execute(self):
+        super(Query, self).execute()
+
+        docs = self._docs(self.tree)
+        self._docs2papers(docs[k] for k in sorted(docs))
+
+    def matches(self, keys):
+        def match(node):
+            op = node[0]
+            if op=='key':
+                value = node[2]
+                if value.endswith('*'):
+                    return any(k.startswith(value[:-1])
+                               for k in keys.get(node[1], ()))
+                return value in keys.get(node[1], ())
+            elif op=='range':
+                low, high = node[2], node[3]
+                return any((low is None or low<=k) and
+                           (high is None or k<=high)
+                           for k in keys.get(node[1], ()))
+            elif op=='or':
+                return any(match(n) for n in node[1])
+            elif op=='and':
+                return all(match(n) for n in node[1])
+            return not match(node[1])
+        return match(self.tree)
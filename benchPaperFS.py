@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+'''
+Microbenchmarks of the PaperFS hot paths. Nothing gets mounted; the file
+system objects are driven directly with synthetic papers.
+
+usage: benchPaperFS.py stat [N]      getattr on N paper entries
+       benchPaperFS.py read [MiB]    reads from a PDF of the given size into
+                                     a buffer, as fusepy's read does
+'''
+
+import sys, os, timeit, random, tempfile
+import ctypes
+import datetime, calendar
+
+import DataModel
+from SearchPaper import Search
+from PaperFS import PaperFS, DirSearch, PDFFile, Stat
+
+class ListSearch(Search):
+    '''
+    A search whose result is a fixed list of papers
+    '''
+    def __init__(self, papers):
+        super(ListSearch, self).__init__(None)
+        self._papers = papers
+
+    def execute(self):
+        pass
+
+def makePapers(n):
+    rnd = random.Random(0)
+    papers = []
+    for i in xrange(n):
+        date = datetime.datetime(2000, 1, 1) + \
+               datetime.timedelta(seconds=rnd.randint(0, 10**9))
+        papers.append(DataModel.Paper(
+            doc_id=u'D-%d' % i,
+            title=u'Paper number %d' % i,
+            year=1950 + i % 70,
+            authors=[DataModel.Author(lastname=u'Smith', firstname=u'J%d' % i)],
+            date_import=date.strftime('%Y-%m-%d %H:%M:%S')))
+    return papers
+
+def report(title, n, seconds):
+    print '%-32s %10.0f ns/op' % (title, seconds/n*1e9)
+
+def benchStat(n):
+    fsys = PaperFS('.')
+    papers = makePapers(n)
+    dirSearch = DirSearch(u'All Papers', parent=fsys, search=ListSearch(papers))
+    names = [name for name, _, _ in dirSearch.readdir()][2:]
+
+    def getattr():
+        for name in names:
+            dirSearch.getattr(name)
+
+    # what getattr used to do for every call: copy the Stat, parse
+    # date_import and build a fresh dict
+    statPapers = dirSearch.statPapers
+    def legacy():
+        for paper in papers:
+            mtime = calendar.timegm(datetime.datetime.strptime(
+                paper.date_import, '%Y-%m-%d %H:%M:%S').timetuple())
+            dict(st_mode=statPapers.st_mode,   st_nlink=statPapers.st_nlink,
+                 st_uid=statPapers.st_uid,     st_gid=statPapers.st_gid,
+                 st_size=statPapers.st_size,   st_atime=statPapers.st_atime,
+                 st_mtime=mtime,               st_ctime=statPapers.st_ctime)
+
+    report('getattr on paper entries', n, min(timeit.repeat(getattr, number=1, repeat=5)))
+    report('per-call Stat + strptime', n, min(timeit.repeat(legacy, number=1, repeat=5)))
+
+    shared = all(dirSearch.getattr(name) is dirSearch.getattr(name)
+                 for name in names)
+    print 'getattr returns the cached dict: %s' % shared
+
+def benchRead(mib):
+    size = mib<<20
+    fd, fpath = tempfile.mkstemp(suffix='.pdf')
+    try:
+        chunk = os.urandom(1<<20)
+        for i in xrange(mib):
+            os.write(fd, chunk)
+        os.close(fd)
+
+        fsys = PaperFS(os.path.dirname(fpath))
+        pdf = PDFFile(u'bench.pdf', fpath, fsys)
+        rnd = random.Random(0)
+        randOffsets = [rnd.randrange(0, size-4096) for i in xrange(20000)]
+
+        def run(read):
+            def sequential():
+                for offset in xrange(0, size, 128<<10):
+                    read(128<<10, offset)
+            def randomReads():
+                for offset in randOffsets:
+                    read(4096, offset)
+            tseq = min(timeit.repeat(sequential, number=1, repeat=5))
+            trnd = min(timeit.repeat(randomReads, number=1, repeat=5))
+            return size/tseq/(1<<20), len(randOffsets)*4096/trnd/(1<<20)
+
+        # a stand-in for the buffer fuse hands to fusepy's read trampoline
+        buf = ctypes.create_string_buffer(128<<10)
+        bufs = {128<<10: buf,
+                4096: (ctypes.c_char*4096).from_buffer(buf)}
+
+        # what a read used to cost: lseek+read on a per-open fd, then two
+        # copies in the trampoline
+        osfd = os.open(fpath, os.O_RDONLY)
+        def legacy(size, offset):
+            os.lseek(osfd, offset, os.SEEK_SET)
+            ret = os.read(osfd, size)
+            ctypes.create_string_buffer(ret, len(ret))
+            ctypes.memmove(buf, ret, len(ret))
+        results = [('lseek+read, 2 copies', run(legacy))]
+        os.close(osfd)
+
+        fh = pdf.open(os.O_RDONLY)
+        def sliced(size, offset):
+            ret = pdf.read(fh, size, offset)
+            ctypes.memmove(buf, ret, len(ret))
+        results.append(('mmap slice + memmove', run(sliced)))
+        results.append(('PDFFile.readinto', run(lambda size, offset:
+                        pdf.readinto(fh, bufs[size], offset))))
+        pdf.release(fh)
+
+        print '%-24s %14s %14s' % ('', 'seq 128KiB', 'random 4KiB')
+        for title, (seq, rnd) in results:
+            print '%-24s %9.0f MiB/s %9.0f MiB/s' % (title, seq, rnd)
+    finally:
+        os.unlink(fpath)
+
+if __name__ == '__main__':
+    benches = {'stat': (benchStat, 10000),
+               'read': (benchRead, 256)}
+    if len(sys.argv) < 2 or not sys.argv[1] in benches:
+        print __doc__
+        sys.exit(1)
+
+    bench, n = benches[sys.argv[1]]
+    if len(sys.argv) > 2: n = int(sys.argv[2])
+    bench(n)
@@ -354,6 +354,9 @@ class FUSE(object):
         self.operations = operations
         self.raw_fi = raw_fi
         self.encoding = encoding
+        self.readinto = getattr(operations, 'readinto', None) is not None
+        self.writefrom = getattr(operations, 'writefrom', None) is not None
+        self.readdirfrom = getattr(operations, 'readdirfrom', None) is not None
 
         args = ['fuse']
         if kwargs.pop('foreground', False):
@@ -468,33 +471,43 @@ class FUSE(object):
 
             return 0
 
+    @staticmethod
+    def _buffer(buf, size):
+        """Returns a ctypes char array aliasing the size bytes at buf"""
+        return cast(buf, POINTER(c_char * size)).contents
+
     def read(self, path, buf, size, offset, fip):
         if self.raw_fi:
           fh = fip.contents
         else:
           fh = fip.contents.fh
 
-        ret = self.operations('read', path.decode(self.encoding), size,
-                                      offset, fh)
+        if self.readinto:
+            retsize = self.operations('readinto', path.decode(self.encoding),
+                                      self._buffer(buf, size), offset, fh)
+        else:
+            ret = self.operations('read', path.decode(self.encoding), size,
+                                          offset, fh)
+            if not ret: return 0
 
-        if not ret: return 0
+            retsize = len(ret)
+            memmove(buf, ret, retsize)
 
-        retsize = len(ret)
         assert retsize <= size, \
             'actual amount read %d greater than expected %d' % (retsize, size)
-
-        data = create_string_buffer(ret, retsize)
-        memmove(buf, ret, retsize)
         return retsize
 
     def write(self, path, buf, size, offset, fip):
-        data = string_at(buf, size)
-
         if self.raw_fi:
             fh = fip.contents
         else:
             fh = fip.contents.fh
 
+        if self.writefrom:
+            return self.operations('writefrom', path.decode(self.encoding),
+                                   self._buffer(buf, size), offset, fh)
+
+        data = string_at(buf, size)
         return self.operations('write', path.decode(self.encoding), data,
                                         offset, fh)
 
@@ -582,16 +595,29 @@ class FUSE(object):
 
     def readdir(self, path, buf, filler, offset, fip):
         # Ignore raw_fi
-        for item in self.operations('readdir', path.decode(self.encoding),
-                                               fip.contents.fh):
+        stats = {}  # id(attrs) -> (attrs, c_stat), for attrs shared by entries
+        if self.readdirfrom:
+            items = self.operations('readdirfrom', path.decode(self.encoding),
+                                    offset, fip.contents.fh)
+        else:
+            items = self.operations('readdir', path.decode(self.encoding),
+                                    fip.contents.fh)
+
+        for item in items:
 
             if isinstance(item, basestring):
                 name, st, offset = item, None, 0
             else:
                 name, attrs, offset = item
                 if attrs:
-                    st = c_stat()
-                    set_st_attrs(st, attrs)
+                    cached = stats.get(id(attrs))
+                    if cached is None:
+                        st = c_stat()
+                        set_st_attrs(st, attrs)
+                        # keeping attrs alive keeps its id from being reused
+                        stats[id(attrs)] = (attrs, st)
+                    else:
+                        st = cached[1]
                 else:
                     st = None
 
@@ -779,6 +805,24 @@ class Operations(object):
         """Returns a string containing the data requested."""
         raise FuseOSError(EIO)
 
+    # Optional copy-free variants of read and write. When defined, they are
+    # called instead, with buf a ctypes char array aliasing the kernel's
+    # buffer (len(buf) is the requested size):
+    #   readinto(self, path, buf, offset, fh) fills buf and returns the
+    #       number of bytes read.
+    #   writefrom(self, path, buf, offset, fh) returns the number of bytes
+    #       written. buf is only valid during the call.
+    readinto = None
+    writefrom = None
+
+    # Optional streaming variant of readdir. When defined, it is called
+    # instead, as readdirfrom(self, path, offset, fh), and must yield
+    # (name, attrs, offset) tuples for the entries after offset, each
+    # with a nonzero offset of its own. Once the kernel's buffer is full
+    # iteration stops, and the listing resumes in a later call from the
+    # offset of the last entry passed on.
+    readdirfrom = None
+
     def readdir(self, path, fh):
         """Can return either a list of names, or a list of
            (name, attrs, offset) tuples. attrs is a dict as in getattr."""